@@ -5,13 +5,141 @@ post to often. It is IP-based.
 """
 
 from flask import request
+from contextlib import contextmanager
 import time
 import json
+import os
+import sqlite3
 import hashlib
 import base64
-
-# Dictionary of all time to wait indexed by IP
-all_users_time = {}
+import heapq
+import threading
+from word_filter import WordMatcher
+
+# ------------------------------- Users tables ------------------------------- #
+
+class MemoryUserTable:
+    """Table of the timeouts of the users indexed by IP, kept in the memory of
+    the process. The timeouts it returns can be modified in place. A heap
+    orders the users by the time they can be forgotten so that they can be
+    removed without looking at the whole table. Heap entries made outdated
+    by a new timeout are skipped when they are popped, and the heap is made
+    again from the table when there are too many of them."""
+    def __init__(self):
+        self.users = {}
+        self.free_at = {}
+        self.expiries = []
+        self.lock = threading.RLock()
+
+    def __str__(self):
+        return str(self.users)
+
+    def __len__(self):
+        return len(self.users)
+
+    def transaction(self):
+        "Context in which the table can be read and modified by a single thread."
+        return self.lock
+
+    def get(self, ip):
+        "Returns the timeout of an user or None if they are not in the table."
+        return self.users.get(ip)
+
+    def put(self, ip, timeout):
+        "Sets the timeout of an user."
+        self.users[ip] = timeout
+        free_at = expiry_time(timeout)
+        if self.free_at.get(ip) != free_at:
+            self.free_at[ip] = free_at
+            heapq.heappush(self.expiries, (free_at, ip))
+            # Banned users get a new entry at each attempt, which is never popped
+            if len(self.expiries) > 2 * len(self.users) + 64:
+                self.expiries = [(free_at, ip) for ip, free_at in self.free_at.items()]
+                heapq.heapify(self.expiries)
+
+    def items(self):
+        "Returns a list of all the pairs of IP and timeout."
+        return list(self.users.items())
+
+    def expire(self, now):
+        """Removes the users that can be forgotten. If the table is still too
+        big, the users the closest to it are removed too."""
+        while self.expiries and (self.expiries[0][0] < now or len(self.users) > MAX_TRACKED_USERS):
+            free_at, ip = heapq.heappop(self.expiries)
+            if self.free_at.get(ip) == free_at:
+                del self.users[ip]
+                del self.free_at[ip]
+
+class SharedUserTable:
+    """Table of the timeouts of the users stored in an SQLite file, so that
+    all the processes of the server share it. The timeouts it returns are
+    copies that must be put back once modified."""
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.last_expire = 0
+        self.connection().execute("CREATE TABLE IF NOT EXISTS users (ip TEXT PRIMARY KEY, timeout TEXT NOT NULL, free_at INTEGER NOT NULL)")
+        self.connection().execute("CREATE INDEX IF NOT EXISTS users_free_at ON users (free_at)")
+
+    def __str__(self):
+        return str(dict(self.items()))
+
+    def __len__(self):
+        return self.connection().execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def connection(self):
+        "Returns the connection of the current thread."
+        try:
+            return self.local.connection
+        except AttributeError:
+            self.local.connection = sqlite3.connect(self.path, isolation_level=None, timeout=10)
+            self.local.connection.execute("PRAGMA journal_mode=WAL")
+            self.local.depth = 0
+            return self.local.connection
+
+    @contextmanager
+    def transaction(self):
+        "Context in which the table can be read and modified by a single thread."
+        connection = self.connection()
+        if self.local.depth == 0:
+            connection.execute("BEGIN IMMEDIATE")
+        self.local.depth += 1
+        try:
+            yield
+        except:
+            self.local.depth -= 1
+            if self.local.depth == 0:
+                connection.execute("ROLLBACK")
+            raise
+        self.local.depth -= 1
+        if self.local.depth == 0:
+            connection.execute("COMMIT")
+
+    def get(self, ip):
+        row = self.connection().execute("SELECT timeout FROM users WHERE ip = ?", (ip,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, ip, timeout):
+        self.connection().execute("INSERT OR REPLACE INTO users (ip, timeout, free_at) VALUES (?, ?, ?)", (ip, json.dumps(timeout), expiry_time(timeout)))
+
+    def items(self):
+        rows = self.connection().execute("SELECT ip, timeout FROM users").fetchall()
+        return [(ip, json.loads(timeout)) for ip, timeout in rows]
+
+    def expire(self, now):
+        """Same as for MemoryUserTable, but as counting the users is costly in
+        SQLite, it is only done once per second."""
+        if now - self.last_expire < 1000:
+            return
+        self.last_expire = now
+        connection = self.connection()
+        connection.execute("DELETE FROM users WHERE free_at < ?", (now,))
+        excess = len(self) - MAX_TRACKED_USERS
+        if excess > 0:
+            connection.execute("DELETE FROM users WHERE ip IN (SELECT ip FROM users ORDER BY free_at LIMIT ?)", (excess,))
+
+# Table of all time to wait indexed by IP
+all_users_time = MemoryUserTable()
 
 # --------------------------------- Constants -------------------------------- #
 
@@ -30,6 +158,21 @@ LIMIT_FIRST_CONNECTION = True
 # Time to wait between the first connection and the fist post
 FIST_CONNECTION_DELAY_MS = 1000 * 60 * 5
 
+# Time after their first attempt during which a user who has not posted yet is
+# remembered, so that they do not have to wait again when they come back
+FIRST_TIME_TTL_MS = 1000 * 60 * 60 * 24
+
+# Maximum number of users whose timeouts are remembered. When there are more,
+# the ones the closest to being forgotten are forgotten first. Set from the
+# anti_spam_max_users setting.
+MAX_TRACKED_USERS = 100_000
+
+# Banned users simply have an infinitely long time to wait before posting again
+BAN_MULTIPLIER = 10**10
+
+# Time between two checks for changes in the lists of verified and banned users
+CHECK_LISTS_INTERVAL_MS = 1000
+
 # ----------------------------- Helper functions ----------------------------- #
 
 def my_hash(s):
@@ -76,24 +219,50 @@ def is_allowed_to_post(timeout):
         timeout["extra_delay"] = 0
     return ret
 
+def free_time(timeout):
+    "Returns the time at which a user will be free from their timeout."
+    return int(timeout["last_post"] + MULTIPLIER_TIMEOUT_MS * timeout["multiplier"] + timeout["extra_delay"])
+
+def expiry_time(timeout):
+    """Returns the time at which a user can be removed from the table of
+    timeouts. Users who have not posted yet are kept longer than their
+    timeout, as forgetting them would make them wait again."""
+    if timeout.get("first_time"):
+        return max(free_time(timeout), timeout["last_post"] + FIRST_TIME_TTL_MS)
+    return free_time(timeout)
+
 def is_free_from_timeout(timeout):
     "Tells if we should remove a user from the list of timeouts."
-    end = timeout["last_post"] + MULTIPLIER_TIMEOUT_MS * timeout["multiplier"] + timeout["extra_delay"]
-    now = millis()
-    return now > end
+    return millis() > free_time(timeout)
 
 def update_user(timeout):
     "Update the last_post and the multiplier field for an user."
     timeout["multiplier"] = timeout["multiplier"] * TIME_TO_WAIT_MULTIPLICATOR
     timeout["last_post"] = millis()
 
-def gc_list():
-    "Compute if any user should be removed from the list of timeouts."
-    to_del = []
-    for k in all_users_time.keys():
-        if is_free_from_timeout(all_users_time[k]):
-            all_users_time[k]["multiplier"] = 1
-            all_users_time[k]["extra_delay"] = 0
+def reset_timeout(timeout):
+    "Resets the multiplier of a user free from their timeout."
+    timeout["multiplier"] = 1
+    timeout["extra_delay"] = 0
+
+def get_timeout(ip):
+    """Returns the timeout of a user or None if they are unknown. As idle users
+    are removed from the table, the timeouts of verified and banned users are
+    made again when they are not found."""
+    timeout = all_users_time.get(ip)
+    if ip in banned_users and (timeout is None or timeout["multiplier"] < BAN_MULTIPLIER):
+        timeout = init_timeout(True)
+        timeout["multiplier"] = BAN_MULTIPLIER
+    elif timeout is not None and timeout["multiplier"] >= BAN_MULTIPLIER and ip not in banned_users:
+        reset_timeout(timeout) # The user has been unbanned
+    elif timeout is None and ip in verified_users:
+        timeout = init_timeout(False)
+        timeout["last_post"] = 0
+    return timeout
+
+def table_size():
+    "Returns the number of users in the table of timeouts."
+    return len(all_users_time)
 
 # --------------------------------- Main API --------------------------------- #
 
@@ -104,92 +273,222 @@ manage_request_ret = {
 }
 
 def manage_request(request):
-    try:
-        timeout = all_users_time[get_IP(request)]
+    ip = get_IP(request)
+    verified_users.refresh()
+    banned_users.refresh()
+    with all_users_time.transaction():
+        all_users_time.expire(millis())
+        timeout = get_timeout(ip)
+        if timeout is None:
+            all_users_time.put(ip, init_timeout(True))
+            if LIMIT_FIRST_CONNECTION:
+                return manage_request_ret["First_time"], FIST_CONNECTION_DELAY_MS
+            else:
+                return manage_request_ret["OK"], 0
         if is_allowed_to_post(timeout):
             if is_free_from_timeout(timeout):
-                gc_list()
+                reset_timeout(timeout)
             update_user(timeout)
             if LIMIT_FIRST_CONNECTION and timeout["first_time"]:
-                verify_user(get_IP(request))
-            return manage_request_ret["OK"], 0
+                verify_user(ip)
+                timeout["first_time"] = False
+            ret = manage_request_ret["OK"], 0
         else:
             update_user(timeout)
             next_post = time_until_next_post(timeout)
-            return manage_request_ret["Limit"], next_post
-    except KeyError:
-        all_users_time[get_IP(request)] = init_timeout(True)
-        if LIMIT_FIRST_CONNECTION:
-            return manage_request_ret["First_time"], FIST_CONNECTION_DELAY_MS
-        else:
-            return manage_request_ret["OK"], 0
+            ret = manage_request_ret["Limit"], next_post
+        all_users_time.put(ip, timeout)
+        return ret
+
+def is_rate_limited(request):
+    """Tells if a known user must still wait before posting, without counting
+    it as an attempt to post."""
+    with all_users_time.transaction():
+        timeout = get_timeout(get_IP(request))
+        return timeout is not None and time_until_next_post(timeout) >= 0
 
 def get_IP(request):
     "Returns the IP of the sender, even being an Nginx reverse-proxy."
     return my_hash(request.environ.get('HTTP_X_REAL_IP', request.remote_addr))
 
-# -------------------------- List of verified users -------------------------- #
+# ------------------------- Lists of verified and bans ------------------------ #
+
+class WatchedList:
+    """Set of hashed IPs read from two files. The JSON file holds an array of
+    hashes and is only read. The list file holds one hash per line and new
+    hashes are appended to it. Both files are checked for changes at most
+    once per CHECK_LISTS_INTERVAL_MS. When the list file only grew, only its
+    new lines are read, otherwise everything is read again."""
+    def __init__(self, json_file, list_file, name):
+        self.json_file = json_file
+        self.list_file = list_file
+        self.name = name
+        self.hashes = set()
+        self.json_stat = None
+        self.list_stat = None
+        self.list_offset = 0
+        self.last_check = 0
+        self.lock = threading.Lock()
+        self.reload()
+
+    def __contains__(self, ip):
+        return ip in self.hashes
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def reload(self):
+        "Reads both files from the start."
+        hashes = set()
+        self.json_stat = file_stat(self.json_file)
+        try:
+            with open(self.json_file, "r") as f:
+                file_content = f.read()
+            hashes.update(json.loads(file_content))
+        except:
+            if self.list_stat is None and file_stat(self.list_file) is None:
+                print("Error, unable to open list of " + self.name + ".")
+        self.hashes = hashes
+        self.list_offset = 0
+        self.read_list()
+
+    def read_list(self):
+        "Reads the complete lines added to the list file since the last read."
+        self.list_stat = file_stat(self.list_file)
+        try:
+            with open(self.list_file, "rb") as f:
+                f.seek(self.list_offset)
+                new_content = f.read()
+        except FileNotFoundError:
+            return
+        complete = new_content[:new_content.rfind(b"\n")+1]
+        self.list_offset += len(complete)
+        for line in complete.decode("UTF-8").split("\n"):
+            if line.strip() != "":
+                self.hashes.add(line.strip())
+
+    def refresh(self):
+        "Takes into account the changes made to the files by other programs."
+        now = millis()
+        if now - self.last_check < CHECK_LISTS_INTERVAL_MS:
+            return
+        with self.lock:
+            self.last_check = now
+            list_stat = file_stat(self.list_file)
+            if file_stat(self.json_file) != self.json_stat:
+                self.reload()
+            elif list_stat != self.list_stat:
+                if list_stat is None or self.list_stat is None or list_stat[0] != self.list_stat[0] or list_stat[1] < self.list_offset:
+                    self.reload() # The list file was replaced or shortened
+                else:
+                    self.read_list()
+
+    def add(self, ip):
+        """Adds a hash to the set and at the end of the list file. A single
+        small write in append mode is atomic, so several processes can add
+        hashes at once."""
+        if ip in self.hashes:
+            return
+        self.hashes.add(ip)
+        with open(self.list_file, "a") as f:
+            f.write(ip + "\n")
+
+def file_stat(path):
+    "Returns the inode, size and modification time of a file or None if it does not exist."
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
 
 VERIFIED_USERS_LIST = "verified.json"
-try:
-    with open(VERIFIED_USERS_LIST, "r") as f:
-        file_content = f.read()
-    list_of_verified = json.loads(file_content)
-    for user in list_of_verified:
-        all_users_time[user] = init_timeout(False)
-except:
-    print("Error, unable to open list of verified IPs.")
+VERIFIED_USERS_APPEND_LIST = "verified.list"
+verified_users = WatchedList(VERIFIED_USERS_LIST, VERIFIED_USERS_APPEND_LIST, "verified IPs")
 
 def verify_user(user_id):
     "Add an user to the list of verified users."
-    try:
-        with open(VERIFIED_USERS_LIST, "r") as f:
-            file_content = f.read()
-        list_of_verified = json.loads(file_content)
-    except:
-        list_of_verified = []
-    list_of_verified.append(user_id)
-    with open(VERIFIED_USERS_LIST, "w") as f:
-        f.write(json.dumps(list_of_verified))
+    verified_users.add(user_id)
 
 # ------------------------------ Handeling bans ------------------------------ #
 
-# Reads a JSON of banned IP hashed
+# Reads a JSON of banned IP hashed and a list with one banned hash per line
 BANNED_IP_FILE = "bans.json"
-try:
-    with open(BANNED_IP_FILE, "r") as f:
-        file_content = f.read()
-    list_of_bans = json.loads(file_content)
-    for banned in list_of_bans:
-        all_users_time[banned] = init_timeout(True)
-        # Ban people simply have an infinitely long time to wait before posting again.
-        all_users_time[banned]["multiplier"] = 10**10 
-except:
-    print("Error, unable to open list of banned IPs.")
+BANNED_IP_APPEND_LIST = "bans.list"
+banned_users = WatchedList(BANNED_IP_FILE, BANNED_IP_APPEND_LIST, "banned IPs")
+
+def set_max_tracked_users(count):
+    "Sets the number of users whose timeouts are remembered."
+    global MAX_TRACKED_USERS
+    if count < 1:
+        raise ValueError("At least one user must be remembered by the anti-spam.")
+    MAX_TRACKED_USERS = count
+
+def use_shared_table(path):
+    """Replaces the table of timeouts by one stored in an SQLite file, to be
+    shared with the other processes of the server."""
+    global all_users_time
+    all_users_time = SharedUserTable(path)
 
 # ---------------------------------- Filters --------------------------------- #
 
+# The file contains either an array of words forbidden on every board or an
+# object whose keys are board names and whose values are arrays of words
+# forbidden on that board. The words under the key "*" are forbidden on every
+# board.
 BAD_WORDS_FILE = "bad_words.json"
-bad_words = []
-try:
-    with open(BAD_WORDS_FILE, "r") as f:
-        file_content = f.read()
-    bad_words = json.loads(file_content)
-except:
-    print("Error, unable to open list of banned words.")
-
-def try_to_filter(msg, request):
-    """Try to find some of the bad words in the message.
+bad_words_matchers = {"*": WordMatcher([])}
+bad_words_stat = None
+bad_words_last_check = 0
+
+def set_bad_words(bad_words):
+    "Compiles the words of the bad words file into a matcher for each board."
+    global bad_words_matchers
+    if isinstance(bad_words, list):
+        bad_words = {"*": bad_words}
+    common = bad_words.get("*", [])
+    matchers = {"*": WordMatcher(common)}
+    for board in bad_words:
+        if board != "*":
+            matchers[board] = WordMatcher(common + bad_words[board])
+    bad_words_matchers = matchers
+
+def load_bad_words():
+    "Reads the bad words file."
+    global bad_words_stat
+    bad_words_stat = file_stat(BAD_WORDS_FILE)
+    try:
+        with open(BAD_WORDS_FILE, "r") as f:
+            file_content = f.read()
+        set_bad_words(json.loads(file_content))
+    except:
+        print("Error, unable to open list of banned words.")
+
+def refresh_bad_words():
+    "Reads the bad words file again if it changed."
+    global bad_words_last_check
+    now = millis()
+    if now - bad_words_last_check < CHECK_LISTS_INTERVAL_MS:
+        return
+    bad_words_last_check = now
+    if file_stat(BAD_WORDS_FILE) != bad_words_stat:
+        load_bad_words()
+
+load_bad_words()
+
+def try_to_filter(msg, request, board=None):
+    """Try to find some of the bad words of the board in the message.
     If they are found, return False and increase the multiplier
     of the IP in the request. If they are not found, return True."""
-    m = msg.lower()
-    for bad_word in bad_words:
-        if m.find(bad_word) != -1:
-            timeout = all_users_time[get_IP(request)]
+    refresh_bad_words()
+    matcher = bad_words_matchers.get(board, bad_words_matchers["*"])
+    if matcher.search(msg.lower()):
+        ip = get_IP(request)
+        with all_users_time.transaction():
+            timeout = get_timeout(ip)
             timeout["multiplier"] *= 100
-            return False
+            all_users_time.put(ip, timeout)
+        return False
     return True
-            
 
 # ---------------------------------- Testing --------------------------------- #
 
@@ -201,7 +500,7 @@ if __name__ == '__main__':
     def get_IP(x):
         return x
     print("---- Test Filter ----")
-    bad_words = ["123"]
+    set_bad_words(["123"])
     manage_request(3)
     print(try_to_filter("56789", 3))
     print(try_to_filter("5678901234", 3))
@@ -0,0 +1,592 @@
+#!/usr/bin/env python3
+"""
+This file contains the answers to the requests made to the server, without
+anything specific to a web framework. It is used by the Flask server in
+cyberland.py and by the asynchronous one in cyberland_asgi.py so that both
+have the same parameters and the same error strings.
+"""
+
+import json
+import time
+import random
+import threading
+from db import DataBase
+from cache import ResponseCache, etag, etag_matches
+from anti_spam import get_IP
+from validation import validate_post
+from post_log import PostLog, PurgeList
+from search import tokenize
+from compression import ENCODINGS, compressible, negotiate, compress, encoded_etag
+from rate_limit import RateLimiter, budget_of, client_of, refusal
+import anti_spam
+import metrics
+
+# Time between two checks for new posts to erase in the purge list
+CHECK_PURGES_INTERVAL_S = 1
+ANTI_SPAM_FILE = "anti_spam.sqlite"
+# Most words a search can look for, as each one is a posting list to go through
+MAX_SEARCH_TOKENS = 8
+# Parameters of the reads of a batch, as in the URL of a read
+BATCH_READ_PARAMETERS = ["thread", "num", "offset", "since", "after", "before"]
+
+class Reply:
+    """The answer to a request. The body is a string or bytes and the headers
+    are a dictionary of the headers added to the content type. A reply whose
+    body is cached tells where, as its cache, the bucket of the cache, its
+    key and the version of its board, so that its compressed bodies are
+    cached with it. posts is the number of posts the reply holds, which the
+    rate limiter charges."""
+    def __init__(self, body, status=200, mimetype="text/html", headers=None, cached_as=None, posts=0):
+        self.body = body
+        self.status = status
+        self.mimetype = mimetype
+        self.headers = {} if headers is None else headers
+        self.cached_as = cached_as
+        self.posts = posts
+
+class Client:
+    """The parts of a request used by the anti-spam, for servers that do not
+    give Flask requests."""
+    def __init__(self, remote_addr, real_ip=None):
+        self.remote_addr = remote_addr
+        self.environ = {} if real_ip is None else {"HTTP_X_REAL_IP": real_ip}
+
+def to_json(obj):
+    "Encodes an object in JSON like Flask's jsonify."
+    return json.dumps(obj, separators=(",", ":"), sort_keys=True) + "\n"
+
+def json_reply(obj):
+    return Reply(to_json(obj), mimetype="application/json")
+
+def error(message):
+    return Reply(message, 400)
+
+NO_SUCH_BOARD = "Error, requested board does not exits."
+
+def cursors(posts, thread, since, before):
+    """The headers giving the cursors of the pages around a read: the
+    smallest ID to use as before and the greatest ID to use as after. The OP
+    of a thread is not taken into account. For an empty page, the cursors of
+    the request are given back."""
+    ids = [post["id"] for post in posts if post["id"] != thread]
+    before_cursor = min(ids) if ids else before
+    after_cursor = max(ids) if ids else since
+    headers = {}
+    if before_cursor is not None:
+        headers["X-Cursor-Before"] = str(before_cursor)
+    if after_cursor is not None:
+        headers["X-Cursor-After"] = str(after_cursor)
+    return headers
+
+class API:
+    """The state of the server and the answers to its requests. If a
+    background writer is given, the disk writes of the database are left
+    to it."""
+    def __init__(self, server_config, settings, writer=None):
+        self.server_config = server_config
+        self.settings = settings
+        self.writer = writer
+        self.db = DataBase(server_config, "db", settings, writer)
+        anti_spam.set_max_tracked_users(settings["anti_spam_max_users"])
+        if settings["shared_anti_spam"]:
+            anti_spam.use_shared_table(ANTI_SPAM_FILE)
+        self.response_cache = ResponseCache(server_config.keys(), settings["response_cache_size"])
+        # The compressed bodies of the pages about all the boards, one per encoding
+        self.page_cache = ResponseCache(["status", "boards"], len(ENCODINGS))
+        self.db.add_listener(self.response_cache.invalidate)
+        self.post_log = PostLog(max_bytes=settings["log_rotate_bytes"],
+                                max_age_s=settings["log_rotate_hours"] * 3600,
+                                flush_interval_ms=settings["log_flush_interval_ms"])
+        self.rate_limiter = RateLimiter(settings) if settings["rate_limit"] else None
+        self.purges = PurgeList()
+        self.apply_purges()
+        threading.Thread(target=self.watch_purges, daemon=True).start()
+        metrics.enable(settings["metrics"])
+        if settings["metrics"]:
+            self.db.add_listener(metrics.post_made)
+            metrics.add_gauge(self.gauges)
+
+    # ------------------------------ Default pages ----------------------------- #
+
+    def txt(self, filename):
+        "Renders a txt file from the `txt` folder."
+        with open("txt/" + filename, "r") as f:
+            txt = f.read()
+        return Reply(txt, mimetype="text/plain")
+
+    def example_board(self):
+        "Picks the board shown as example on the root page."
+        return random.choice(list(self.server_config.keys()))
+
+    def config(self):
+        "The config of all boards."
+        return json_reply(self.server_config)
+
+    def status(self):
+        "The number of posts in each boards."
+        ret = {}
+        for k in self.db.boards():
+            ret[k] = self.db.post_count(k)
+        reply = json_reply(ret)
+        reply.cached_as = (self.page_cache, "status", None, self.versions())
+        return reply
+
+    def boards(self):
+        "A description slimmer than /status but longer than /config."
+        ret = []
+        for server in self.server_config:
+            serv_formated = {
+                    "slug":      self.server_config[server]["name"],
+                    "name":      self.server_config[server]["long_name"],
+                    "charLimit": self.server_config[server]["max_post_size"],
+                    "post":      self.db.post_count(self.server_config[server]["name"])}
+            ret.append(serv_formated)
+        reply = json_reply(ret)
+        reply.cached_as = (self.page_cache, "boards", None, self.versions())
+        return reply
+
+    def versions(self):
+        "The versions of all the boards, which change with the pages about all of them."
+        return tuple(self.db.version(board) for board in self.db.boards())
+
+    def metrics_page(self):
+        "The metrics of the server, in the text format of Prometheus."
+        if not metrics.enabled:
+            return Reply("Error, metrics are disabled.", 404)
+        return Reply(metrics.render(), mimetype="text/plain")
+
+    def gauges(self):
+        "The metrics read from the state of the server."
+        ret = [("cyberland_anti_spam_users", {}, anti_spam.table_size())]
+        ret += [("cyberland_board_posts", {"board": board}, self.db.post_count(board)) for board in self.db.boards()]
+        return ret + metrics.posts_last_minute(self.db.boards())
+
+    # -------------------------------- Posting -------------------------------- #
+
+    def post(self, board, form, request):
+        """Makes a post from the form of a request. The request is the one
+        given to the anti-spam."""
+        # Checking if board exists
+        try:
+            board_config = self.server_config[board]
+        except KeyError:
+            return error(NO_SUCH_BOARD)
+        if self.settings["replica"]:
+            return Reply("Error, this server is a read-only replica, posts are made on its primary.", 403)
+
+        # Checking the post
+        content = form.get('content')
+        rejection, replyTo = validate_post(board, board_config, content, form.get('replyTo'), request)
+        if rejection is not None:
+            metrics.count("cyberland_anti_spam_rejects_total", {"reason": rejection.reason})
+            return error(rejection.message)
+
+        # Posting
+        postOK, id = self.db.auto_post(board, content, replyTo)
+        if postOK:
+            self.log_post(request, board, id)
+            return Reply("OK")
+        else:
+            return error("Not OK")
+
+    def log_post(self, request, board, id):
+        "Writes who made a post in the log file."
+        self.post_log.log(str(get_IP(request)), board, id)
+
+    def apply_purges(self):
+        "Erases the posts added to the purge list since the last check."
+        for board, id in self.purges.read_new():
+            if board in self.server_config:
+                self.db.erase(board, id)
+
+    def watch_purges(self):
+        while True:
+            time.sleep(CHECK_PURGES_INTERVAL_S)
+            self.apply_purges()
+
+    # -------------------------------- Reading -------------------------------- #
+
+    def parse_read(self, board, args):
+        """Checks the parameters of a read. Returns an error Reply, or None
+        and the read to make. When the read is a long poll, its "wait" field
+        is the number of seconds to wait for a new post before answering."""
+        # Checking if board exists
+        try:
+            board_config = self.server_config[board]
+        except KeyError:
+            return error(NO_SUCH_BOARD), None
+
+        # Validated request form
+        num = args.get('num')
+        thread = args.get('thread')
+        offset = args.get('offset')
+        since = args.get('since', args.get('after'))
+        before = args.get('before')
+        wait = args.get('wait')
+        if not num:
+            num = '100' #TODO: config
+        if num.isdigit():
+            num_int = int(num)
+        else:
+            return error("Num parameter is not a number"), None
+        if not offset:
+            offset = '0'
+        if not offset.isdigit():
+            return error("Offset parameter is not a number"), None
+        offset = int(offset)
+        if since:
+            if not since.isdigit():
+                return error("Since parameter is not a number"), None
+            since = int(since)
+        else:
+            since = None
+        if before:
+            if not before.isdigit():
+                return error("Before parameter is not a number"), None
+            before = int(before)
+        else:
+            before = None
+        if not wait:
+            wait = '0'
+        if not wait.isdigit():
+            return error("Wait parameter is not a number"), None
+        wait = min(int(wait), self.settings["long_poll_max_s"])
+
+        # Limiting reply size
+        if not thread:
+            if board_config["max_replies_no_thread"] != 0:
+                if board_config["max_replies_no_thread"] < num_int:
+                    num_int = board_config["max_replies_no_thread"]
+        else:
+            if board_config["max_replies_thread"] != 0:
+                if board_config["max_replies_thread"] < num_int:
+                    num_int = board_config["max_replies_thread"]
+
+        # Parsing the thread
+        if not thread:
+            thread_int = None
+        elif thread.isdigit():
+            thread_int = int(thread)
+        elif thread == "null":
+            thread_int = 0
+        else:
+            return error("Thread parameter is not a number"), None
+
+        # Long polls are only held on existing threads
+        if since is None:
+            wait = 0
+        if wait > 0 and thread_int is not None and not self.db.get_post(board, thread_int)[1]:
+            return error("Error, no such thread as " + thread), None
+
+        return None, {
+                "board":  board,
+                "thread": thread_int,
+                "thread_name": thread,
+                "num":    num_int,
+                "offset": offset,
+                "since":  since,
+                "before": before,
+                "wait":   wait}
+
+    def read(self, read, if_none_match=None):
+        """Answers a read checked by parse_read, once the wait of long polls
+        is over. The If-None-Match header of the request lets the server
+        answer without any work if the board did not change. The reply
+        carries the cursors to read the pages before and after it."""
+        board = read["board"]
+        thread_int = read["thread"]
+        num_int = read["num"]
+        offset = read["offset"]
+        since = read["since"]
+        before = read["before"]
+
+        version = self.db.version(board)
+        tag = etag(board, version)
+        headers = {"ETag": '"' + tag + '"'}
+        if etag_matches(if_none_match, tag):
+            metrics.count("cyberland_response_cache_total", {"result": "not_modified"})
+            return Reply("", 304, headers=headers)
+        key = (thread_int, num_int, offset, since, before)
+        cached = self.response_cache.get(board, key, version)
+        metrics.count("cyberland_response_cache_total", {"result": "miss" if cached is None else "hit"})
+
+        if cached is None:
+            if thread_int is not None:
+                OP, post_OK = self.db.get_post(board, thread_int)
+                if not post_OK:
+                    return error("Error, no such thread as " + read["thread_name"])
+            # Reading the page before a cursor
+            if before is not None:
+                if thread_int is None:
+                    reply = self.db.get_last_posts(board, num_int, before=before, since=since)
+                else:
+                    reply = self.db.get_first_replies(board, num_int, thread_int, 0, since, before)
+            # Reading posts newer than since
+            elif since is not None:
+                if thread_int is None:
+                    reply = self.db.get_posts_since(board, since, num_int)
+                else:
+                    reply = self.db.get_first_replies(board, num_int, thread_int, 0, since)
+            # Reading last posts
+            elif thread_int is None:
+                reply = self.db.get_last_posts(board, num_int, offset)
+            # Reading part of a thread
+            elif offset == 0:
+                reply = [OP] + self.db.get_first_replies(board, num_int-1, thread_int)
+            else:
+                reply = self.db.get_first_replies(board, num_int, thread_int, offset-1)
+            cached = (to_json(reply).encode("UTF-8"), cursors(reply, thread_int, since, before), len(reply))
+            self.response_cache.put(board, key, version, cached)
+
+        body, cursor_headers, posts = cached
+        headers.update(cursor_headers)
+        return Reply(body, mimetype="application/json", headers=headers, cached_as=(self.response_cache, board, key, version), posts=posts)
+
+    # --------------------------------- Batch ---------------------------------- #
+
+    def batch(self, body):
+        """Answers several reads in one request. The body is a JSON array of
+        reads, each one an object with the board and the parameters of a read
+        of the board, without wait. Each read is checked and capped like a
+        read made alone and is answered from the response cache. The reply
+        is an array with, in the same order, the posts and the cursors of
+        each read, or its error, so that a wrong read does not fail the
+        others."""
+        try:
+            reads = json.loads(body)
+        except ValueError:
+            return error("Error, the batch is not valid JSON.")
+        if not isinstance(reads, list):
+            return error("Error, the batch must be an array of reads.")
+        if len(reads) > self.settings["batch_max_reads"]:
+            return error("Error, too many reads in the batch.")
+
+        # The cached bodies of the reads are pasted in the reply, not decoded
+        items = []
+        posts = 0
+        for spec in reads:
+            if not isinstance(spec, dict) or not isinstance(spec.get("board"), str):
+                items.append(to_json({"error": "Error, a read of the batch has no board."}).rstrip("\n").encode("UTF-8"))
+                continue
+            args = {k: str(spec[k]) for k in BATCH_READ_PARAMETERS if spec.get(k) is not None}
+            reply, read = self.parse_read(spec["board"], args)
+            if reply is None:
+                read["wait"] = 0
+                reply = self.read(read)
+            body = reply.body if isinstance(reply.body, bytes) else reply.body.encode("UTF-8")
+            if reply.status != 200:
+                items.append(to_json({"error": body.decode("UTF-8")}).rstrip("\n").encode("UTF-8"))
+                continue
+            fields = [b'"' + name.encode("UTF-8") + b'":' + reply.headers[header].encode("UTF-8")
+                      for name, header in (("cursorAfter", "X-Cursor-After"), ("cursorBefore", "X-Cursor-Before"))
+                      if header in reply.headers]
+            items.append(b"{" + b",".join(fields + [b'"posts":' + body.rstrip(b"\n")]) + b"}")
+            posts += reply.posts
+        return Reply(b"[" + b",".join(items) + b"]\n", mimetype="application/json", posts=posts)
+
+    # -------------------------------- Catalog -------------------------------- #
+
+    def catalog(self, board, args, if_none_match=None):
+        """Answers a read of the catalog of a board: its threads ordered by
+        their last bump with a preview of their last replies."""
+        # Checking if board exists
+        try:
+            board_config = self.server_config[board]
+        except KeyError:
+            return error(NO_SUCH_BOARD)
+
+        # Validated request form
+        num = args.get('num')
+        offset = args.get('offset')
+        if not num:
+            num = '100'
+        if not num.isdigit():
+            return error("Num parameter is not a number")
+        num = int(num)
+        if board_config["max_replies_no_thread"] != 0:
+            num = min(num, board_config["max_replies_no_thread"])
+        if not offset:
+            offset = '0'
+        if not offset.isdigit():
+            return error("Offset parameter is not a number")
+        offset = int(offset)
+
+        # The catalog changes with the board, so reads of both share their ETag
+        version = self.db.version(board)
+        tag = etag(board, version)
+        headers = {"ETag": '"' + tag + '"'}
+        if etag_matches(if_none_match, tag):
+            metrics.count("cyberland_response_cache_total", {"result": "not_modified"})
+            return Reply("", 304, headers=headers)
+        key = ("catalog", num, offset)
+        cached = self.response_cache.get(board, key, version)
+        metrics.count("cyberland_response_cache_total", {"result": "miss" if cached is None else "hit"})
+        if cached is None:
+            threads = self.db.get_catalog(board, num, offset)
+            # Each thread is sent with the preview of its replies
+            posts = sum(1 + len(thread["lastReplies"]) for thread in threads)
+            cached = (to_json(threads).encode("UTF-8"), posts)
+            self.response_cache.put(board, key, version, cached)
+        body, posts = cached
+        return Reply(body, mimetype="application/json", headers=headers, cached_as=(self.response_cache, board, key, version), posts=posts)
+
+    # -------------------------------- Search --------------------------------- #
+
+    def search(self, board, args, if_none_match=None):
+        """Answers a search in a board: the posts containing every word of the
+        q parameter, whatever their case, the most recent first. The results
+        are paged like reads of the board, with offset or the before and
+        after cursors."""
+        # Checking if board exists
+        try:
+            board_config = self.server_config[board]
+        except KeyError:
+            return error(NO_SUCH_BOARD)
+        if not self.settings["search"]:
+            return Reply("Error, search is disabled.", 404)
+
+        # Validated request form
+        tokens = tokenize(args.get('q', ''))
+        if not tokens:
+            return error("Error, no words to search for.")
+        if len(tokens) > MAX_SEARCH_TOKENS:
+            return error("Error, too many words to search for.")
+        num = args.get('num')
+        offset = args.get('offset')
+        since = args.get('since', args.get('after'))
+        before = args.get('before')
+        if not num:
+            num = '100'
+        if not num.isdigit():
+            return error("Num parameter is not a number")
+        num = int(num)
+        if board_config["max_replies_no_thread"] != 0:
+            num = min(num, board_config["max_replies_no_thread"])
+        if not offset:
+            offset = '0'
+        if not offset.isdigit():
+            return error("Offset parameter is not a number")
+        offset = int(offset)
+        if since:
+            if not since.isdigit():
+                return error("Since parameter is not a number")
+            since = int(since)
+        else:
+            since = None
+        if before:
+            if not before.isdigit():
+                return error("Before parameter is not a number")
+            before = int(before)
+        else:
+            before = None
+
+        # The results change with the board, so reads of both share their ETag
+        version = self.db.version(board)
+        tag = etag(board, version)
+        headers = {"ETag": '"' + tag + '"'}
+        if etag_matches(if_none_match, tag):
+            metrics.count("cyberland_response_cache_total", {"result": "not_modified"})
+            return Reply("", 304, headers=headers)
+        key = ("search", tuple(sorted(tokens)), num, offset, since, before)
+        cached = self.response_cache.get(board, key, version)
+        metrics.count("cyberland_response_cache_total", {"result": "miss" if cached is None else "hit"})
+        if cached is None:
+            reply = self.db.search(board, tokens, num, offset, before, since)
+            cached = (to_json(reply).encode("UTF-8"), cursors(reply, None, since, before), len(reply))
+            self.response_cache.put(board, key, version, cached)
+
+        body, cursor_headers, posts = cached
+        headers.update(cursor_headers)
+        return Reply(body, mimetype="application/json", headers=headers, cached_as=(self.response_cache, board, key, version), posts=posts)
+
+    # ------------------------------- Rate limit ------------------------------ #
+
+    def admit(self, remote_addr, real_ip, method, path):
+        """Takes a request from the budget of its client, given the address of
+        the connection and the X-Real-IP header. Returns None if the request
+        can be answered, otherwise the Reply refusing it."""
+        if self.rate_limiter is None:
+            return None
+        wait_s = self.rate_limiter.admit(client_of(remote_addr, real_ip), budget_of(method, path))
+        if wait_s is None:
+            return None
+        message, headers = refusal(wait_s)
+        return Reply(message, 429, headers=headers)
+
+    def charge(self, remote_addr, real_ip, method, path, posts):
+        "Takes from the budget of the client of a request the cost of the posts of its reply."
+        if self.rate_limiter is not None and posts > 0:
+            self.rate_limiter.charge(client_of(remote_addr, real_ip), budget_of(method, path), posts)
+
+    # ------------------------------ Compression ------------------------------ #
+
+    def compress(self, reply, accept_encoding, if_none_match=None):
+        """Compresses the body of a reply with the encoding accepted by the
+        client, given its Accept-Encoding header, if it is long enough. The
+        compressed bodies of cached replies are cached with them, so that a
+        body is only compressed once for each version of its board. A 304
+        gets the ETag of the body the client holds, given its If-None-Match
+        header, compressed if it was sent with the encoding negotiated."""
+        if reply.status == 304 and "ETag" in reply.headers:
+            headers = dict(reply.headers, Vary="Accept-Encoding")
+            encoding = negotiate(accept_encoding)
+            if encoding is not None and if_none_match:
+                tag = encoded_etag(headers["ETag"].strip('"'), encoding)
+                if tag in (candidate.strip().strip('"') for candidate in if_none_match.split(",")):
+                    headers["ETag"] = '"' + tag + '"'
+            return Reply(reply.body, reply.status, reply.mimetype, headers, posts=reply.posts)
+        if reply.status != 200 or not compressible(reply.mimetype):
+            return reply
+        headers = dict(reply.headers, Vary="Accept-Encoding")
+        body = reply.body if isinstance(reply.body, bytes) else reply.body.encode("UTF-8")
+        encoding = negotiate(accept_encoding)
+        level = self.settings["compression_level"]
+        if encoding is None or level <= 0 or len(body) < self.settings["compression_min_bytes"]:
+            return Reply(body, reply.status, reply.mimetype, headers, posts=reply.posts)
+
+        compressed = None
+        if reply.cached_as is not None:
+            cache, bucket, key, version = reply.cached_as
+            compressed = cache.get(bucket, (encoding, key), version)
+        metrics.count("cyberland_compressed_bodies_total", {"result": "miss" if compressed is None else "hit"})
+        if compressed is None:
+            compressed = compress(body, encoding, level)
+            if reply.cached_as is not None:
+                cache.put(bucket, (encoding, key), version, compressed)
+
+        headers["Content-Encoding"] = encoding
+        # The compressed body is another representation, with its own ETag
+        if "ETag" in headers:
+            headers["ETag"] = '"' + encoded_etag(headers["ETag"].strip('"'), encoding) + '"'
+        return Reply(compressed, reply.status, reply.mimetype, headers, posts=reply.posts)
+
+    # ------------------------------- Streaming ------------------------------- #
+
+    def parse_stream(self, board, since):
+        """Checks the parameters of a stream, where since comes from the
+        parameters or from the Last-Event-ID header. Returns an error Reply,
+        or None and the ID after which the posts are sent."""
+        if board not in self.server_config:
+            return error(NO_SUCH_BOARD), None
+        if not since:
+            return None, self.db.next_id(board) - 1
+        if since.isdigit():
+            return None, int(since)
+        return error("Since parameter is not a number"), None
+
+    def stream_events(self, board, since):
+        """Returns the Server-Sent Events of the posts made after since and the
+        ID of the last one sent. If there are more posts than allowed in a
+        read, only the newest ones are sent."""
+        max_replies = self.server_config[board]["max_replies_no_thread"]
+        newest = self.db.next_id(board) - 1
+        if max_replies != 0 and newest - since > max_replies:
+            since = newest - max_replies
+        events = []
+        for post in reversed(self.db.get_posts_since(board, since, newest - since)):
+            events.append("id: " + str(post["id"]) + "\ndata: " + json.dumps(post) + "\n\n")
+            since = post["id"]
+        return events, since
+
+STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+KEEP_ALIVE = ": keep-alive\n\n"
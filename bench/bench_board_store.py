@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+This benchmark compares the memory used and the time needed to load a board
+stored as a list of dictionaries, as the server used to do, and as a
+columnar Board, from the JSON file and from a binary snapshot. The number of
+posts can be given as argument.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import tracemalloc
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from db import Board, iter_json_array
+
+def make_board_file(path, num_posts):
+    "Writes a board file of random posts with realistic sizes."
+    rng = random.Random(42)
+    with open(path, "w") as f:
+        f.write("[")
+        for i in range(num_posts):
+            if i != 0:
+                f.write(", ")
+            post = {
+                    "id":        i,
+                    "time":      1_600_000_000 + i,
+                    "replyTo":   rng.randrange(i) if i and rng.random() < 0.8 else 0,
+                    "content":   "x" * rng.randrange(20, 400),
+                    "bumpCount": 0}
+            f.write(json.dumps(post))
+        f.write("]")
+
+def measure(name, load, runs=3):
+    """Loads a board a few times to keep its fastest time, and once more to
+    trace the memory it uses, as tracing slows down the loading."""
+    duration = None
+    for i in range(runs):
+        start = time.perf_counter()
+        load()
+        elapsed = time.perf_counter() - start
+        duration = elapsed if duration is None else min(duration, elapsed)
+    tracemalloc.start()
+    board = load()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(name + ": load " + format(duration, ".2f") + " s, memory " + str(current // 1024) + " KiB, peak " + str(peak // 1024) + " KiB")
+    return board
+
+def load_dicts(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+def load_board(path):
+    with open(path, "r") as f:
+        return Board.from_posts(iter_json_array(f))
+
+if __name__ == '__main__':
+    num_posts = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    with tempfile.TemporaryDirectory() as tmp:
+        path = tmp + "/board.json"
+        make_board_file(path, num_posts)
+        print(str(num_posts) + " posts, file of " + str(os.path.getsize(path) // 1024) + " KiB")
+        measure("list of dictionaries   ", lambda: load_dicts(path))
+        board = measure("columnar board         ", lambda: load_board(path))
+        board.write_snapshot(tmp + "/board.snap")
+        measure("columnar board, binary ", lambda: Board.from_snapshot(tmp + "/board.snap"))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+This benchmark compares the startup of the JSON backend with a board stored
+as a JSON file and as a binary snapshot. For each format, a synthetic board
+is loaded in a process of its own, which reports the time taken to load it,
+the time of the first read of its last posts and its peak resident memory.
+Usage: bench_snapshot.py [posts]
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import tempfile
+import subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from synthetic import make_board
+
+BOARD = "x"
+BOARD_CONFIG = {"x": {"name": BOARD, "description": "A synthetic board."}}
+
+def load(workdir, snapshot_format):
+    "Starts the store of a board and returns what was measured, in JSON."
+    from db import JSONStore
+    from config import default_settings
+    settings = default_settings()
+    settings["snapshot_format"] = snapshot_format
+    settings["json_export_interval_s"] = 0
+    start = time.perf_counter()
+    store = JSONStore(BOARD_CONFIG, workdir, settings)
+    startup = time.perf_counter() - start
+    start = time.perf_counter()
+    store.last(BOARD, 100, store.count(BOARD))
+    first_read = time.perf_counter() - start
+    return json.dumps({"startup_s": startup, "first_read_ms": first_read * 1000, "peak_rss_mib": peak_rss_kib() / 1024})
+
+def peak_rss_kib():
+    """The peak resident memory of the process. The one given by getrusage is
+    kept across exec, so it would count the board made by the parent."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except FileNotFoundError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == "--load":
+        print(load(sys.argv[2], sys.argv[3]))
+        sys.exit(0)
+    num_posts = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    board = make_board(num_posts)
+    for snapshot_format in ("json", "binary"):
+        with tempfile.TemporaryDirectory() as workdir:
+            if snapshot_format == "json":
+                size = board.write_json(workdir + "/" + BOARD + ".json")
+            else:
+                size = board.write_snapshot(workdir + "/" + BOARD + ".snap")
+            process = subprocess.run([sys.executable, os.path.abspath(__file__), "--load", workdir, snapshot_format],
+                                     stdout=subprocess.PIPE, check=True, text=True)
+            result = json.loads(process.stdout)
+            print(format(snapshot_format, "6") + ": file " + str(size // 1024 // 1024) + " MiB, startup "
+                  + format(result["startup_s"], ".2f") + " s, first read " + format(result["first_read_ms"], ".2f")
+                  + " ms, peak RSS " + format(result["peak_rss_mib"], ".0f") + " MiB")
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+This suite benchmarks the server on synthetic boards of several sizes. For
+each size, a server is prepared in a temporary directory and the functions
+used by each request are timed, then the main routes are load tested with
+the Flask test client. Each size is run in its own process so that the
+state of a size does not change the results of the next one.
+The results are written as JSON. Giving the results of an older version
+with --compare prints the changes and exits with an error on regressions.
+Usage: bench_suite.py [--sizes 10000,100000] [--requests 1000] [--output results.json] [--compare old.json]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import datetime
+import tempfile
+import subprocess
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO)
+from synthetic import make_board, busiest_thread
+
+BOARD = "x"
+BOARD_CONFIG = {
+        "name":                  BOARD,
+        "long_name":             "synthetic",
+        "description":           "A synthetic board.",
+        "enable_ansi_code":      False,
+        "max_post_size":         "2000",
+        "max_replies_no_thread": 1000}
+# No compaction while update_db is timed, as both write the board file
+SETTINGS = {"journal": True, "compaction_threshold": 10**9, "rate_limit": False}
+BAD_WORDS = ["spam" + str(i) for i in range(100)]
+
+# A change of more than this share of a median time is reported as a regression
+REGRESSION_THRESHOLD = 0.15
+
+def timed(function, min_time=0.5, min_runs=5, max_runs=100_000):
+    """Calls a function until it ran for min_time seconds and at least
+    min_runs times. Returns statistics on the time of a call."""
+    times = []
+    total = 0
+    while (total < min_time or len(times) < min_runs) and len(times) < max_runs:
+        start = time.perf_counter()
+        function()
+        duration = time.perf_counter() - start
+        times.append(duration)
+        total += duration
+    return stats(times)
+
+def stats(times):
+    times = sorted(times)
+    return {
+            "runs":      len(times),
+            "mean_us":   round(sum(times) / len(times) * 1e6, 2),
+            "p50_us":    round(times[len(times) // 2] * 1e6, 2),
+            "p99_us":    round(times[min(len(times) - 1, len(times) * 99 // 100)] * 1e6, 2),
+            "ops_per_s": round(len(times) / sum(times), 1)}
+
+def cycle(values):
+    "Returns a function giving the values one after the other, endlessly."
+    state = {"i": -1}
+    def next_value():
+        state["i"] = (state["i"] + 1) % len(values)
+        return values[state["i"]]
+    return next_value
+
+def prepare_dir(num_posts, num_posters):
+    """Makes the directory of a server with a synthetic board. The posters of
+    the load test are verified users. Returns the directory and the busiest
+    thread of the board."""
+    from anti_spam import my_hash
+    workdir = tempfile.mkdtemp()
+    os.mkdir(workdir + "/db")
+    board = make_board(num_posts)
+    board.write_snapshot(workdir + "/db/" + BOARD + ".snap")
+    thread = busiest_thread(board)
+    with open(workdir + "/config.json", "w") as f:
+        json.dump([BOARD_CONFIG], f)
+    with open(workdir + "/server.json", "w") as f:
+        json.dump(SETTINGS, f)
+    with open(workdir + "/verified.list", "w") as f:
+        for i in range(num_posters):
+            f.write(my_hash(poster_ip(i)) + "\n")
+    return workdir, thread, board.bumps[thread]
+
+def poster_ip(i):
+    return "10." + str(i // 65536) + "." + str(i // 256 % 256) + "." + str(i % 256)
+
+def microbenchmarks(db, thread):
+    "Times the functions used by the requests."
+    import anti_spam
+    from api import Client
+    from synthetic import make_contents
+    from search import tokenize
+    import random
+    results = {}
+    results["get_last_posts"] = timed(lambda: db.get_last_posts(BOARD, 100))
+    results["get_last_posts_deep"] = timed(lambda: db.get_last_posts(BOARD, 100, db.next_id(BOARD) // 2))
+    results["get_first_replies"] = timed(lambda: db.get_first_replies(BOARD, 100, thread))
+    results["get_first_replies_since"] = timed(lambda: db.get_first_replies(BOARD, 100, thread, 0, db.next_id(BOARD) // 2))
+    results["get_catalog"] = timed(lambda: db.get_catalog(BOARD, 100, 0))
+    results["search"] = timed(lambda: db.search(BOARD, tokenize("modem terminal"), 100))
+    results["new_post"] = timed(lambda: db.auto_post(BOARD, "A benchmark post.", thread))
+    results["update_db"] = timed(lambda: db.store.update_db(BOARD), min_time=0, min_runs=3)
+    anti_spam.set_bad_words(BAD_WORDS)
+    messages = cycle(make_contents(random.Random(1)))
+    client = Client("127.0.0.1")
+    results["try_to_filter"] = timed(lambda: anti_spam.try_to_filter(messages(), client, BOARD))
+    clients = cycle([Client("192.168." + str(i // 256) + "." + str(i % 256)) for i in range(10_000)])
+    results["manage_request"] = timed(lambda: anti_spam.manage_request(clients()))
+    anti_spam.set_bad_words([])
+    return results
+
+def load_test(app, thread, num_requests):
+    "Times the main routes, called with the Flask test client."
+    client = app.test_client()
+    posters = cycle([poster_ip(i) for i in range(num_requests)])
+    # The reads of the two first routes in a single request
+    batch = json.dumps([{"board": BOARD, "num": 100}, {"board": BOARD, "num": 100, "thread": thread}])
+    routes = {
+            "GET /<board>":          lambda: client.get("/" + BOARD + "?num=100"),
+            "GET /<board>?thread=":  lambda: client.get("/" + BOARD + "?num=100&thread=" + str(thread)),
+            "GET /<board>/catalog":  lambda: client.get("/" + BOARD + "/catalog?num=100"),
+            "GET /<board>/search":   lambda: client.get("/" + BOARD + "/search?q=modem+terminal&num=100"),
+            "POST /batch":           lambda: client.post("/batch", data=batch),
+            "POST /<board>":         lambda: client.post("/" + BOARD, data={"content": "A load test post.", "replyTo": str(thread)},
+                                                         headers={"X-Real-IP": posters()}),
+            "GET /status":           lambda: client.get("/status")}
+    results = {}
+    for route in routes:
+        statuses = {}
+        times = []
+        for i in range(num_requests):
+            start = time.perf_counter()
+            response = routes[route]()
+            times.append(time.perf_counter() - start)
+            statuses[str(response.status_code)] = statuses.get(str(response.status_code), 0) + 1
+        results[route] = stats(times)
+        results[route]["statuses"] = statuses
+    return results
+
+def run_size(num_posts, num_requests):
+    "Benchmarks a single size. Meant to run in a process of its own."
+    start = time.perf_counter()
+    workdir, thread, replies = prepare_dir(num_posts, num_requests)
+    generation = time.perf_counter() - start
+    os.chdir(workdir)
+    start = time.perf_counter()
+    import cyberland
+    startup = time.perf_counter() - start
+    result = {
+            "posts":        num_posts,
+            "thread":       thread,
+            "replies":      replies,
+            "generation_s": round(generation, 3),
+            "startup_s":    round(startup, 3)}
+    result["http"] = load_test(cyberland.app, thread, num_requests)
+    result["micro"] = microbenchmarks(cyberland.db, thread)
+    os.chdir(REPO)
+    shutil.rmtree(workdir)
+    return result
+
+def run_all(sizes, num_requests):
+    results = []
+    for size in sizes:
+        process = subprocess.run([sys.executable, os.path.abspath(__file__), "--one", str(size), "--requests", str(num_requests)],
+                                 stdout=subprocess.PIPE, check=True, text=True)
+        results.append(json.loads(process.stdout.strip().splitlines()[-1]))
+        print("Benchmarked " + str(size) + " posts.", file=sys.stderr)
+    return {
+            "commit":   git_commit(),
+            "date":     datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python":   platform.python_version(),
+            "platform": platform.platform(),
+            "settings": SETTINGS,
+            "requests": num_requests,
+            "results":  results}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(old, new):
+    """Prints the change of the median time of each measure found in both
+    results. The median is used as it is less noisy than the mean. Returns
+    the number of regressions."""
+    regressions = 0
+    old_sizes = {result["posts"]: result for result in old["results"]}
+    for result in new["results"]:
+        if result["posts"] not in old_sizes:
+            continue
+        old_result = old_sizes[result["posts"]]
+        for group in ("micro", "http"):
+            for name in result[group]:
+                if name not in old_result.get(group, {}):
+                    continue
+                before = old_result[group][name]["p50_us"]
+                after = result[group][name]["p50_us"]
+                change = (after - before) / before if before else 0
+                regression = change > REGRESSION_THRESHOLD
+                regressions += regression
+                print(str(result["posts"]) + " posts, " + group + " " + name + ": " + str(before) + " us -> " + str(after)
+                      + " us (" + format(change * 100, "+.1f") + " %)" + (" REGRESSION" if regression else ""))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks the server on synthetic boards.")
+    parser.add_argument("--sizes", default="10000,100000", help="Comma separated numbers of posts, up to a few millions.")
+    parser.add_argument("--requests", type=int, default=1000, help="Number of requests made to each route.")
+    parser.add_argument("--output", help="File where the results are written, instead of the standard output.")
+    parser.add_argument("--compare", help="Results of an older version to compare with.")
+    parser.add_argument("--one", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one is not None:
+        # Child process: the JSON result is the last line of the output
+        print(json.dumps(run_size(args.one, args.requests)))
+        sys.exit(0)
+
+    results = run_all([int(size) for size in args.sizes.split(",")], args.requests)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+    else:
+        print(json.dumps(results, indent=1))
+    if args.compare:
+        with open(args.compare, "r") as f:
+            old = json.load(f)
+        if compare(old, results):
+            sys.exit(1)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+This benchmark measures the hot window of the JSON backend. A synthetic board
+is stored as a binary snapshot, with its old posts archived when there is a
+hot window, and is loaded in a process of its own without hot window and
+with one, where as many posts as the board holds are made, as a long running
+server would. Once the old posts are archived, the process
+reports how much its resident memory grew with the posts, the size of the
+segments and the time of reads of recent posts, of old posts spread over the
+whole board and of old posts of the same segment.
+Usage: bench_tiering.py [posts] [hot posts]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from synthetic import make_board
+
+BOARD = "x"
+BOARD_CONFIG = {"x": {"name": BOARD, "description": "A synthetic board."}}
+READS = 1000
+# Small, so that reads spread over the board miss the cache
+SEGMENT_CACHE_MB = 8
+
+def timed_reads(store, ids):
+    "Reads the posts of a list of IDs. Returns the mean time of a read in µs."
+    start = time.perf_counter()
+    for id in ids:
+        store.get(BOARD, id)
+    return (time.perf_counter() - start) / len(ids) * 1e6
+
+def start_store(workdir, hot_posts):
+    from db import JSONStore
+    from config import default_settings
+    settings = default_settings()
+    settings["json_export_interval_s"] = 0
+    settings["journal"] = True
+    settings["journal_fsync_every"] = 1 << 30
+    settings["compaction_threshold"] = 1 << 30
+    settings["hot_posts"] = hot_posts
+    settings["segment_cache_mb"] = SEGMENT_CACHE_MB
+    return JSONStore(BOARD_CONFIG, workdir, settings)
+
+def archive(workdir, hot_posts):
+    "Archives the old posts of the board and writes its snapshot."
+    store = start_store(workdir, hot_posts)
+    while store.archiving:
+        time.sleep(0.1)
+    store.update_db(BOARD)
+
+def load(workdir, hot_posts):
+    "Starts the store of a board, makes posts, waits for their archiving and returns what was measured, in JSON."
+    store = start_store(workdir, hot_posts)
+    rss_start = rss_kib()
+    count = store.count(BOARD)
+    rng = random.Random(42)
+    contents = [store.get(BOARD, rng.randrange(count))["content"] for i in range(1000)]
+    for i in range(count):
+        store.append(BOARD, {"id": None, "replyTo": rng.randrange(count), "time": i, "content": contents[i % len(contents)]})
+    while store.archiving:
+        time.sleep(0.1)
+    count = store.count(BOARD)
+    old_end = max(count - max(hot_posts, 10000), 1)
+    segments_dir = store.segments_dir(BOARD)
+    segments_size = sum(os.path.getsize(os.path.join(segments_dir, name)) for name in os.listdir(segments_dir)) if os.path.isdir(segments_dir) else 0
+    return json.dumps({
+        "rss_growth_mib": (rss_kib() - rss_start) / 1024,
+        "segments_mib": segments_size / 1024 / 1024,
+        "recent_us": timed_reads(store, [rng.randrange(count - 1000, count) for i in range(READS)]),
+        "old_spread_us": timed_reads(store, [rng.randrange(old_end) for i in range(READS)]),
+        "old_close_us": timed_reads(store, [rng.randrange(min(old_end, 1000)) for i in range(READS)]),
+    })
+
+def rss_kib():
+    "The current resident memory of the process."
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == "--load":
+        print(load(sys.argv[2], int(sys.argv[3])))
+        sys.exit(0)
+    num_posts = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    hot = int(sys.argv[2]) if len(sys.argv) > 2 else 50_000
+    board = make_board(num_posts)
+    for hot_posts in (0, hot):
+        with tempfile.TemporaryDirectory() as workdir:
+            board.write_snapshot(workdir + "/" + BOARD + ".snap")
+            archive(workdir, hot_posts)
+            process = subprocess.run([sys.executable, os.path.abspath(__file__), "--load", workdir, str(hot_posts)],
+                                     stdout=subprocess.PIPE, check=True, text=True)
+            result = json.loads(process.stdout)
+            print("hot posts " + format(hot_posts, "7") + ": RSS growth " + format(result["rss_growth_mib"], ".0f") + " MiB, segments "
+                  + format(result["segments_mib"], ".1f") + " MiB, reads of recent posts " + format(result["recent_us"], ".1f")
+                  + " µs, of old posts " + format(result["old_spread_us"], ".1f") + " µs, of close old posts "
+                  + format(result["old_close_us"], ".1f") + " µs")
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+This benchmark compares the checks made on max-size posts before and after
+validate_post: the loop over each character looking for ANSI codes and the
+loop looking for each bad word against the precompiled regular expression
+and automaton, and the cost of rejecting a user who must wait.
+Usage: bench_validation.py [post size] [bad words]
+"""
+
+import os
+import sys
+import time
+import random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import anti_spam
+from validation import validate_post, ANSI_CODE
+from word_filter import WordMatcher
+
+class Request:
+    "The fields of a Flask request used by the anti-spam."
+    def __init__(self, ip):
+        self.environ = {}
+        self.remote_addr = ip
+
+def old_ansi_check(content):
+    for i in content:
+        chr_int = ord(i)
+        if chr_int < 32 and i != "\n" and i != "\r" and i != "\t":
+            return False
+    return True
+
+def old_words_check(content, bad_words):
+    m = content.lower()
+    for bad_word in bad_words:
+        if m.find(bad_word) != -1:
+            return False
+    return True
+
+def bench(name, function, repeat):
+    "Prints the mean time of a function."
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    print(name + ": " + format((time.perf_counter() - start) / repeat * 1e6, ".1f") + " µs")
+
+if __name__ == '__main__':
+    post_size = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    num_words = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    rng = random.Random(42)
+    content = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz \n") for _ in range(post_size))
+    bad_words = ["".join(rng.choice("ABCDEFGHIJ") for _ in range(8)) for _ in range(num_words)]
+    board_config = {"max_post_size": post_size, "enable_ansi_code": False}
+    anti_spam.set_bad_words(bad_words)
+    matcher = WordMatcher(bad_words)
+    print("Posts of " + str(post_size) + " characters, " + str(num_words) + " bad words")
+
+    bench("ANSI codes, loop over characters    ", lambda: old_ansi_check(content), 200)
+    bench("ANSI codes, regular expression      ", lambda: ANSI_CODE.search(content), 200)
+    bench("content checks, loops               ", lambda: old_ansi_check(content) and old_words_check(content, bad_words), 200)
+    bench("content checks, regex and automaton ", lambda: ANSI_CODE.search(content) or matcher.search(content.lower()), 200)
+
+    # A user who must wait used to have their post read before being rejected
+    request = Request("127.0.0.1")
+    anti_spam.manage_request(request)
+    def old_rejection():
+        old_ansi_check(content)
+        anti_spam.manage_request(request)
+    bench("user who must wait, before          ", old_rejection, 200)
+    bench("user who must wait, validate_post   ", lambda: validate_post("x", board_config, content, "0", request), 200)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+This benchmark compares the WordMatcher used to look for bad words with the
+loop of str.find it replaced. Usage: bench_word_filter.py [words] [post size]
+"""
+
+import os
+import sys
+import time
+import random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from word_filter import WordMatcher
+
+def random_word(rng):
+    return "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randrange(4, 12)))
+
+def find_loop(bad_words, msg):
+    "The filter as it used to be."
+    for bad_word in bad_words:
+        if msg.find(bad_word) != -1:
+            return True
+    return False
+
+def bench(name, function, posts, repeat):
+    "Runs a filter on every post and prints the mean time per post."
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = [function(post) for post in posts]
+    duration = (time.perf_counter() - start) / (repeat * len(posts))
+    print(name + ": " + format(duration * 1e6, ".1f") + " µs per post")
+    return results
+
+if __name__ == '__main__':
+    num_words = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    post_size = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    rng = random.Random(42)
+    bad_words = [random_word(rng) for _ in range(num_words)]
+    posts = []
+    for i in range(20):
+        post = " ".join(random_word(rng) for _ in range(post_size // 6))[:post_size]
+        if i % 4 == 0: # Some posts contains a bad word at their end
+            post = post[:post_size - 12] + rng.choice(bad_words)
+        posts.append(post.lower())
+
+    start = time.perf_counter()
+    matcher = WordMatcher(bad_words)
+    print(str(num_words) + " words compiled in " + format(time.perf_counter() - start, ".2f") + " s")
+    expected = bench("str.find loop", lambda post: find_loop(bad_words, post), posts, 1)
+    results = bench("WordMatcher  ", matcher.search, posts, 5)
+    if results != expected:
+        print("Error, the results differ.")
+        sys.exit(1)
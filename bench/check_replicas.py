@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+This script checks the read replicas with several processes on one machine.
+A primary and two replicas of cyberland_asgi.py share a temporary directory.
+Posts are made on the primary with frequent compactions of its journal, the
+replicas being started at different times. It checks that posts are refused
+by the replicas, measures how long a post takes to be seen by them and checks
+that in the end they serve the same board as the primary. It needs uvicorn.
+Usage: check_replicas.py [posts]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import subprocess
+import http.client
+from urllib.parse import urlencode
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO)
+from anti_spam import my_hash
+
+PORT = 8921
+BOARD = "x"
+# Small, so that the journal is rotated while the replicas follow it
+COMPACTION_THRESHOLD = 50
+
+def request(port, method, url, body=None, headers={}):
+    "Makes a request on a new connection. Returns the status and the body."
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    try:
+        connection.request(method, url, body, headers)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+def poster_ip(i):
+    return "10.0." + str(i // 256) + "." + str(i % 256)
+
+def prepare_dir(num_posters):
+    "Makes the directory shared by the servers, with the settings of the primary and of the replicas."
+    workdir = tempfile.mkdtemp()
+    os.mkdir(os.path.join(workdir, "db"))
+    shutil.copy(os.path.join(REPO, "config.json"), workdir)
+    with open(os.path.join(workdir, "verified.list"), "w") as f:
+        for i in range(num_posters):
+            f.write(my_hash(poster_ip(i)) + "\n")
+    settings = {"journal": True, "compaction_threshold": COMPACTION_THRESHOLD, "rate_limit": False}
+    with open(os.path.join(workdir, "server.json"), "w") as f:
+        json.dump(settings, f)
+    with open(os.path.join(workdir, "replica.json"), "w") as f:
+        json.dump(dict(settings, replica=True), f)
+    return workdir
+
+def start_server(workdir, port, settings_file):
+    env = dict(os.environ, CYBERLAND_SETTINGS=settings_file)
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "--app-dir", os.path.abspath(REPO), "cyberland_asgi:app",
+                               "--port", str(port), "--log-level", "warning"],
+                              cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            request(port, "GET", "/status")
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("The server on port " + str(port) + " did not start.")
+
+def post_count(port):
+    return json.loads(request(port, "GET", "/status")[1])[BOARD]
+
+def make_posts(start, end, replicas, lags, rng):
+    """Makes the posts from the poster start to end on the primary, waiting
+    for each of them to be seen by the replicas."""
+    for i in range(start, end):
+        count = post_count(PORT)
+        body = urlencode({"content": "Post " + str(i), "replyTo": str(rng.randrange(count))})
+        status, reply = request(PORT, "POST", "/" + BOARD, body,
+                                {"Content-Type": "application/x-www-form-urlencoded", "X-Real-IP": poster_ip(i)})
+        if status != 200:
+            raise RuntimeError("Post refused by the primary: " + reply.decode())
+        posted = time.monotonic()
+        for port in replicas:
+            while post_count(port) <= count:
+                if time.monotonic() - posted > 10:
+                    raise RuntimeError("The replica on port " + str(port) + " did not get post " + str(count))
+                time.sleep(0.005)
+            lags.append(time.monotonic() - posted)
+
+def check(num_posts):
+    workdir = prepare_dir(num_posts)
+    servers = [start_server(workdir, PORT, "server.json")]
+    rng = random.Random(42)
+    lags = []
+    failures = []
+    try:
+        # The second replica starts after several compactions
+        servers.append(start_server(workdir, PORT + 1, "replica.json"))
+        make_posts(0, num_posts // 2, [PORT + 1], lags, rng)
+        servers.append(start_server(workdir, PORT + 2, "replica.json"))
+        make_posts(num_posts // 2, num_posts, [PORT + 1, PORT + 2], lags, rng)
+
+        status, reply = request(PORT + 1, "POST", "/" + BOARD, urlencode({"content": "Refused", "replyTo": "0"}),
+                                {"Content-Type": "application/x-www-form-urlencoded", "X-Real-IP": poster_ip(0)})
+        if status != 403:
+            failures.append("A replica accepted a post: " + str(status) + " " + reply.decode())
+
+        reads = ["/" + BOARD + "?num=1000", "/" + BOARD + "/catalog?num=1000", "/status"]
+        reads += ["/" + BOARD + "?thread=" + str(thread) + "&num=1000" for thread in range(0, 20)]
+        for read in reads:
+            expected = request(PORT, "GET", read)
+            for port in (PORT + 1, PORT + 2):
+                if request(port, "GET", read) != expected:
+                    failures.append("The replica on port " + str(port) + " differs on " + read)
+    finally:
+        for server in servers:
+            server.terminate()
+            server.wait()
+        shutil.rmtree(workdir)
+
+    lags.sort()
+    print(str(num_posts) + " posts, replication lag: p50 " + format(lags[len(lags) // 2] * 1000, ".1f")
+          + " ms, max " + format(lags[-1] * 1000, ".1f") + " ms")
+    for failure in failures:
+        print(failure)
+    print("FAILED" if failures else "OK")
+    return not failures
+
+if __name__ == '__main__':
+    num_posts = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    sys.exit(0 if check(num_posts) else 1)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+This load test compares the Flask server of cyberland.py with the
+asynchronous one of cyberland_asgi.py. Each server is started in a
+temporary directory while many clients long poll a board, others read it
+in a loop and one client posts at a steady rate. It reports the reads
+served, their latency and the time between a post and its delivery to the
+long polls. The asynchronous mode needs uvicorn.
+Usage: load_test.py [flask|asgi|both] [seconds] [pollers] [readers] [posts per second]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import http.client
+from urllib.parse import urlencode
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, REPO)
+from anti_spam import my_hash
+
+SERVERS = {"flask": "cyberland.py", "asgi": "cyberland_asgi.py"}
+PORT = 8901
+BOARD = "x"
+
+def request(method, url, body=None, headers={}, timeout=60):
+    "Makes a request on a new connection. Returns the status and the body."
+    connection = http.client.HTTPConnection("127.0.0.1", PORT, timeout=timeout)
+    try:
+        connection.request(method, url, body, headers)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+def poster_ip(i):
+    return "10.0." + str(i // 256) + "." + str(i % 256)
+
+def prepare_dir(num_posters):
+    "Makes the directory of a server, where the posters are verified users."
+    workdir = tempfile.mkdtemp()
+    os.mkdir(os.path.join(workdir, "db"))
+    shutil.copy(os.path.join(REPO, "config.json"), workdir)
+    os.symlink(os.path.abspath(os.path.join(REPO, "txt")), os.path.join(workdir, "txt"))
+    with open(os.path.join(workdir, "verified.list"), "w") as f:
+        for i in range(num_posters):
+            f.write(my_hash(poster_ip(i)) + "\n")
+    with open(os.path.join(workdir, "server.json"), "w") as f:
+        json.dump({"rate_limit": False}, f)
+    return workdir
+
+def start_server(mode, workdir):
+    server = subprocess.Popen([sys.executable, os.path.abspath(os.path.join(REPO, SERVERS[mode]))], cwd=workdir,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            request("GET", "/status", timeout=1)
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("The " + mode + " server did not start.")
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p / 100))] * 1000, 2)
+
+def run(mode, duration, num_pollers, num_readers, posts_per_second):
+    num_posts = int(duration * posts_per_second) + 1
+    workdir = prepare_dir(num_posts)
+    server = start_server(mode, workdir)
+    stop = threading.Event()
+    lock = threading.Lock()
+    read_latencies = []
+    delivery_latencies = []
+    counts = {"posts_ok": 0, "posts_refused": 0, "errors": 0}
+
+    def count(field):
+        with lock:
+            counts[field] += 1
+
+    def poller():
+        since = int(json.loads(request("GET", "/status")[1])[BOARD]) - 1
+        while not stop.is_set():
+            try:
+                status, body = request("GET", "/" + BOARD + "?since=" + str(since) + "&wait=30")
+            except OSError:
+                count("errors")
+                continue
+            now = time.time()
+            if status != 200:
+                count("errors")
+                continue
+            for post in json.loads(body):
+                since = max(since, post["id"])
+                with lock:
+                    delivery_latencies.append(now - float(post["content"]))
+
+    def reader():
+        while not stop.is_set():
+            start = time.monotonic()
+            try:
+                status, body = request("GET", "/" + BOARD + "?num=100")
+            except OSError:
+                count("errors")
+                continue
+            if status != 200:
+                count("errors")
+                continue
+            with lock:
+                read_latencies.append(time.monotonic() - start)
+
+    def poster():
+        for i in range(num_posts):
+            if stop.wait(1 / posts_per_second):
+                return
+            form = urlencode({"content": repr(time.time()), "replyTo": "0"})
+            headers = {"X-Real-IP": poster_ip(i), "Content-Type": "application/x-www-form-urlencoded"}
+            try:
+                status, body = request("POST", "/" + BOARD, form, headers)
+            except OSError:
+                count("errors")
+                continue
+            count("posts_ok" if status == 200 else "posts_refused")
+
+    threads = [threading.Thread(target=poller, daemon=True) for i in range(num_pollers)]
+    threads += [threading.Thread(target=reader, daemon=True) for i in range(num_readers)]
+    threads.append(threading.Thread(target=poster, daemon=True))
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    time.sleep(1) # Letting the last posts reach the pollers
+    with lock:
+        result = {
+                "mode":             mode,
+                "seconds":          duration,
+                "pollers":          num_pollers,
+                "readers":          num_readers,
+                "reads":            len(read_latencies),
+                "reads_per_s":      round(len(read_latencies) / duration, 1),
+                "read_p50_ms":      percentile(read_latencies, 50),
+                "read_p99_ms":      percentile(read_latencies, 99),
+                "deliveries":       len(delivery_latencies),
+                "delivery_p50_ms":  percentile(delivery_latencies, 50),
+                "delivery_p99_ms":  percentile(delivery_latencies, 99)}
+        result.update(counts)
+    server.terminate()
+    server.wait()
+    shutil.rmtree(workdir)
+    return result
+
+if __name__ == '__main__':
+    modes = sys.argv[1] if len(sys.argv) > 1 else "both"
+    duration = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    num_pollers = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    num_readers = int(sys.argv[4]) if len(sys.argv) > 4 else 8
+    posts_per_second = float(sys.argv[5]) if len(sys.argv) > 5 else 5
+    for mode in (SERVERS.keys() if modes == "both" else [modes]):
+        print(json.dumps(run(mode, duration, num_pollers, num_readers, posts_per_second)))
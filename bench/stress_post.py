@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+This stress test makes posts concurrently from many threads and from many
+processes and checks that no post was lost: the IDs must be dense and each
+bumpCount must be the exact number of replies. It also checks that the
+shared table of the anti-spam sees each new user exactly once.
+Usage: stress_post.py [workers] [posts per worker]
+"""
+
+import os
+import sys
+import random
+import tempfile
+import threading
+import multiprocessing
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from db import DataBase
+from config import default_settings
+
+BOARDS = {"a": {"description": "Board a"}, "b": {"description": "Board b"}}
+
+def open_db(db_dir, backend):
+    settings = default_settings()
+    settings["backend"] = backend
+    settings["journal"] = True
+    return DataBase(BOARDS, db_dir, settings)
+
+def post_many(db, num_posts, seed):
+    "Makes posts replying to random existing posts on random boards."
+    rng = random.Random(seed)
+    for i in range(num_posts):
+        board = rng.choice(list(BOARDS.keys()))
+        replyTo = rng.randrange(db.next_id(board))
+        post_OK, id = db.auto_post(board, str(seed) + "-" + str(i), replyTo)
+        if not post_OK:
+            raise RuntimeError("Post refused on board " + board)
+
+def post_in_process(db_dir, backend, num_posts, seed):
+    post_many(open_db(db_dir, backend), num_posts, seed)
+
+def check(db, expected):
+    "Checks that the IDs are dense and that each bumpCount is exact."
+    total = 0
+    for board in BOARDS:
+        posts = db.get_last_posts(board, db.next_id(board))[::-1]
+        replies = [0] * len(posts)
+        for i, post in enumerate(posts):
+            if post["id"] != i:
+                raise RuntimeError("IDs of board " + board + " are not dense.")
+            if i != 0:
+                replies[post["replyTo"]] += 1
+        for post in posts:
+            # The first post starts with a bumpCount of 1
+            if post["bumpCount"] != replies[post["id"]] + (1 if post["id"] == 0 else 0):
+                raise RuntimeError("Wrong bumpCount on post " + str(post["id"]) + " of board " + board + ".")
+        total += len(posts) - 1
+    if total != expected:
+        raise RuntimeError(str(total) + " posts made instead of " + str(expected) + ".")
+
+def stress_threads(backend, workers, num_posts):
+    with tempfile.TemporaryDirectory() as db_dir:
+        db = open_db(db_dir, backend)
+        threads = [threading.Thread(target=post_many, args=(db, num_posts, seed)) for seed in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        check(db, workers * num_posts)
+        check(open_db(db_dir, backend), workers * num_posts) # Checking what was stored
+    print("threads, " + backend + " backend: OK")
+
+def stress_processes(backend, workers, num_posts):
+    with tempfile.TemporaryDirectory() as db_dir:
+        open_db(db_dir, backend)
+        processes = [multiprocessing.Process(target=post_in_process, args=(db_dir, backend, num_posts, seed)) for seed in range(workers)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError("A posting process failed.")
+        check(open_db(db_dir, backend), workers * num_posts)
+    print("processes, " + backend + " backend: OK")
+
+def request_many(path, num_users, queue):
+    "Makes a request for each user and reports the first time ones."
+    import anti_spam
+    anti_spam.use_shared_table(path)
+    anti_spam.get_IP = lambda request: request
+    first_times = 0
+    for user in range(num_users):
+        ret, timeout = anti_spam.manage_request(str(user))
+        if ret == anti_spam.manage_request_ret["First_time"]:
+            first_times += 1
+    queue.put(first_times)
+
+def stress_anti_spam(workers, num_users):
+    with tempfile.TemporaryDirectory() as tmp:
+        queue = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=request_many, args=(tmp + "/anti_spam.sqlite", num_users, queue)) for _ in range(workers)]
+        for process in processes:
+            process.start()
+        first_times = sum(queue.get() for _ in processes)
+        for process in processes:
+            process.join()
+        if first_times != num_users:
+            raise RuntimeError(str(first_times) + " first time users instead of " + str(num_users) + ".")
+    print("processes, shared anti-spam table: OK")
+
+if __name__ == '__main__':
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    num_posts = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    stress_threads("json", workers, num_posts)
+    stress_threads("sqlite", workers, num_posts)
+    stress_processes("sqlite", workers, num_posts)
+    stress_anti_spam(workers, num_posts)
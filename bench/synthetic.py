@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+This file generates synthetic boards for the benchmarks. Posts either start
+a new thread or reply to a thread, most often a recent one, with a few
+replies to random older posts, which gives the uneven fan-out of real
+boards: a few long threads and many short ones. The same seed always gives
+the same board.
+Usage: synthetic.py [posts] [board file]
+"""
+
+import os
+import sys
+import random
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from db import Board
+
+WORDS = ["cyber", "land", "board", "post", "thread", "reply", "server", "client", "text", "ansi",
+         "news", "tech", "retro", "terminal", "modem", "bbs", "hello", "world", "python", "flask"]
+
+# Share of the posts starting a new thread
+NEW_THREAD_RATE = 0.15
+# Share of the replies made to a random post instead of a recent thread
+RANDOM_REPLY_RATE = 0.15
+# Mean distance, in threads, between the newest thread and the one replied to
+RECENT_THREADS = 20
+
+def make_contents(rng, count=1000):
+    "Makes a pool of messages of 20 to 400 characters."
+    contents = []
+    for i in range(count):
+        length = rng.randrange(20, 400)
+        words = []
+        while sum(len(w) + 1 for w in words) < length:
+            words.append(rng.choice(WORDS))
+        contents.append(" ".join(words))
+    return contents
+
+def make_board(num_posts, seed=42):
+    "Makes a Board of num_posts posts, post 0 included."
+    rng = random.Random(seed)
+    contents = make_contents(rng)
+    board = Board()
+    board.append(0, 0, "A synthetic board.", 1)
+    threads = []
+    for i in range(1, num_posts):
+        if not threads or rng.random() < NEW_THREAD_RATE:
+            reply_to = 0
+            threads.append(i)
+        elif rng.random() < RANDOM_REPLY_RATE:
+            reply_to = rng.randrange(i)
+        else:
+            distance = min(int(rng.expovariate(1 / RECENT_THREADS)), len(threads) - 1)
+            reply_to = threads[-1 - distance]
+        board.append(reply_to, 1_600_000_000 + i, contents[i % len(contents)])
+        board.bump(reply_to)
+    return board
+
+def busiest_thread(board):
+    "Returns the ID of the thread with the most replies."
+    best = 1
+    for id in range(1, len(board)):
+        if board.reply_to[id] == 0 and board.bumps[id] > board.bumps[best]:
+            best = id
+    return best
+
+if __name__ == '__main__':
+    num_posts = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    path = sys.argv[2] if len(sys.argv) > 2 else "synthetic.json"
+    board = make_board(num_posts)
+    board.write_json(path)
+    print("Wrote " + str(len(board)) + " posts in " + path + ", busiest thread: " + str(busiest_thread(board)))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+This file contains the cache of the JSON bodies sent when reading boards.
+As most reads are clients polling boards that did not change, the bodies
+are kept until a new post is made on their board.
+"""
+
+import threading
+from collections import OrderedDict
+from compression import ENCODINGS, encoded_etag
+
+class ResponseCache:
+    """Bodies of board reads indexed by board and by the parameters of the
+    read. Each body is stored with the version of the board it was made from
+    so that a body from an outdated board is never used. Each board keeps
+    its most recently used bodies, up to max_entries."""
+    def __init__(self, boards, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = {board: OrderedDict() for board in boards}
+
+    def get(self, board, key, version):
+        "Returns the body cached for the key if it is up to date, None otherwise."
+        with self.lock:
+            try:
+                entry_version, body = self.entries[board][key]
+            except KeyError:
+                return None
+            if entry_version != version:
+                return None
+            self.entries[board].move_to_end(key)
+            return body
+
+    def put(self, board, key, version, body):
+        "Stores the body made for the key from the given version of a board."
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            entries = self.entries[board]
+            entries[key] = (version, body)
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+
+    def invalidate(self, board, post=None):
+        "Forgets all the bodies of a board. Meant to be called on new posts."
+        with self.lock:
+            self.entries[board].clear()
+
+def etag(board, version):
+    "Makes the strong ETag, without its quotes, of a board read."
+    return board + "-" + str(version)
+
+def etag_matches(if_none_match, tag):
+    """Tells if an If-None-Match header contains an unquoted strong ETag, or
+    the ETag of one of its compressed bodies."""
+    if not if_none_match:
+        return False
+    tags = {tag} | {encoded_etag(tag, encoding) for encoding in ENCODINGS}
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.strip('"') in tags:
+            return True
+    return False
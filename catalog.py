@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+This file contains the catalog of the threads of a board. A thread is a post
+replying to the post 0 and its replies are the posts replying to it, as with
+the thread parameter of reads. The catalog is updated on each new post so
+that reading it never goes through the whole board.
+"""
+
+from collections import OrderedDict, deque
+
+class Catalog:
+    """The threads of a board ordered by their last bump. Each thread keeps
+    the IDs of its last few replies. Moving a bumped thread to the end of the
+    ordered dictionary takes a constant time, the most recently bumped thread
+    being the last one."""
+    def __init__(self, preview_size):
+        self.preview_size = preview_size
+        self.threads = OrderedDict()
+        self.count = 1 # The post 0 is not a thread
+
+    def __len__(self):
+        return len(self.threads)
+
+    def add(self, id, reply_to):
+        "Takes a new post into account. Posts must be added in the order of their IDs."
+        if id < self.count:
+            return
+        if reply_to == 0:
+            self.threads[id] = deque(maxlen=self.preview_size)
+        elif reply_to in self.threads:
+            self.threads[reply_to].append(id)
+            self.threads.move_to_end(reply_to)
+        self.count = id + 1
+
+    def add_all(self, start, reply_tos):
+        "Adds the posts from the ID start, given by the list of their replyTo."
+        for i, reply_to in enumerate(reply_tos):
+            self.add(start + i, reply_to)
+
+    def page(self, num, offset):
+        """Returns the IDs of num threads, skipping the offset most recently
+        bumped ones, with the IDs of their last replies, oldest first."""
+        ret = []
+        for i, id in enumerate(reversed(self.threads)):
+            if i < offset:
+                continue
+            if len(ret) >= num:
+                break
+            ret.append((id, list(self.threads[id])))
+        return ret
+
+# ---------------------------------- Testing --------------------------------- #
+
+if __name__ == '__main__':
+    catalog = Catalog(2)
+    catalog.add_all(1, [0, 0, 1, 2, 1, 3, 1])
+    print(catalog.page(10, 0))
+    print(catalog.page(1, 1))
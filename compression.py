@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+This file contains the compression of the bodies sent by the server. The
+encoding is chosen from the Accept-Encoding header of the request, between
+gzip and deflate, which are both made by the standard library.
+"""
+
+import gzip
+import zlib
+
+# Encodings in order of preference when the client accepts several
+ENCODINGS = ["gzip", "deflate"]
+
+def compressible(mimetype):
+    "Tells if the bodies of a type are worth compressing."
+    return mimetype == "application/json" or mimetype.startswith("text/") and mimetype != "text/event-stream"
+
+def negotiate(accept_encoding):
+    """Returns the encoding to use for a request with the given
+    Accept-Encoding header, or None if the body must be sent as it is."""
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for item in accept_encoding.split(","):
+        parts = item.strip().split(";")
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[parts[0].strip().lower()] = quality
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+def compress(body, encoding, level):
+    """Compresses a body. The gzip header carries no date, so that the same
+    body is always compressed the same way. The deflate encoding of HTTP is
+    the zlib format."""
+    if encoding == "gzip":
+        return gzip.compress(body, level, mtime=0)
+    return zlib.compress(body, level)
+
+def encoded_etag(tag, encoding):
+    "The ETag, without its quotes, of a compressed body, which differs from the one of the plain body."
+    return tag + "-" + encoding
+
+# ---------------------------------- Testing --------------------------------- #
+
+if __name__ == '__main__':
+    for header in ["gzip, deflate, br", "deflate", "gzip;q=0, deflate;q=0.5", "*", "br", "", "identity"]:
+        print(repr(header), negotiate(header))
+    body = b'[{"content":"hello"}]' * 100
+    for encoding in ENCODINGS:
+        compressed = compress(body, encoding, 6)
+        print(encoding, len(body), len(compressed), compressed == compress(body, encoding, 6))
@@ -4,7 +4,9 @@ This file contains the code needed to read the configuration file and verify
 its content.
 """
 
+import os
 import json
+import argparse
 
 def json_to_dic(filename):
     """This function opens a file and use reads it as JSON. This does not much
@@ -38,8 +40,12 @@ def format_board_config(dic):
     and finaly, an error message.
     It is meant to be run on the config for a board, not the config for the
     whole server."""
+    return format_fields(dic, config_fields)
+
+def format_fields(dic, fields_list):
+    "Does the work of format_board_config with any list of fields."
     ret = {}
-    for fields in config_fields:
+    for fields in fields_list:
         try:
             config_value = dic[fields["name"]]
             try:
@@ -76,10 +82,107 @@ def read_config_file(filename):
     config_OK, server_config = format_server_config(json_to_dic(filename))
     return config_OK, server_config
 
+def select_boards(server_config, boards):
+    """Keeps the configuration of some boards only, all of them if boards is
+    None. Returns a boolean telling that all of them exist and the
+    configuration of the boards kept."""
+    if boards is None:
+        return True, server_config
+    ret = {}
+    for board in boards:
+        if board not in server_config:
+            print("Error, unknown board " + board + ".")
+            return False, ret
+        ret[board] = server_config[board]
+    return True, ret
+
+# ------------------------------ Server options ------------------------------ #
+
+DEFAULT_PORT = 8901
+
+def server_options(from_command_line):
+    """Returns the list of the boards served by a process, None for all of
+    them, and its port. When the server is run as a script, they are read
+    from the command line. Otherwise, the boards are read from the
+    environment variable CYBERLAND_BOARDS, a comma separated list."""
+    boards = os.environ.get("CYBERLAND_BOARDS")
+    port = DEFAULT_PORT
+    if from_command_line:
+        parser = argparse.ArgumentParser(description="Cyberland server.")
+        parser.add_argument("--boards", default=boards, help="Comma separated names of the boards served, all of them by default.")
+        parser.add_argument("--port", type=int, default=port, help="Port the server listens on.")
+        args = parser.parse_args()
+        boards, port = args.boards, args.port
+    return (boards.split(",") if boards else None), port
+
+# ------------------------------ Server settings ----------------------------- #
+
+# Settings that are not related to a single board. They are read from an
+# optional file and all of them have a default value.
+settings_fields = [
+        {"name": "backend",                  "type": str,  "optional": True, "default": "json"},
+        {"name": "journal",                  "type": bool, "optional": True, "default": False},
+        {"name": "journal_fsync_every",      "type": int,  "optional": True, "default": 32},
+        {"name": "journal_fsync_interval_ms","type": int,  "optional": True, "default": 200},
+        {"name": "compaction_threshold",     "type": int,  "optional": True, "default": 10000},
+        {"name": "snapshot_format",          "type": str,  "optional": True, "default": "binary"},
+        {"name": "json_export_interval_s",   "type": int,  "optional": True, "default": 3600},
+        {"name": "hot_posts",                "type": int,  "optional": True, "default": 0},
+        {"name": "segment_posts",            "type": int,  "optional": True, "default": 1000},
+        {"name": "segment_cache_mb",         "type": int,  "optional": True, "default": 64},
+        {"name": "response_cache_size",      "type": int,  "optional": True, "default": 64},
+        {"name": "compression_level",        "type": int,  "optional": True, "default": 6},
+        {"name": "compression_min_bytes",    "type": int,  "optional": True, "default": 1024},
+        {"name": "long_poll_max_s",          "type": int,  "optional": True, "default": 30},
+        {"name": "shared_anti_spam",         "type": bool, "optional": True, "default": False},
+        {"name": "anti_spam_max_users",      "type": int,  "optional": True, "default": 100_000},
+        {"name": "metrics",                  "type": bool, "optional": True, "default": True},
+        {"name": "batch_max_reads",          "type": int,  "optional": True, "default": 32},
+        {"name": "catalog_preview_size",     "type": int,  "optional": True, "default": 3},
+        {"name": "log_rotate_bytes",         "type": int,  "optional": True, "default": 64 * 1024 * 1024},
+        {"name": "log_rotate_hours",         "type": int,  "optional": True, "default": 0},
+        {"name": "log_flush_interval_ms",    "type": int,  "optional": True, "default": 1000},
+        {"name": "search",                   "type": bool, "optional": True, "default": True},
+        {"name": "search_save_interval_s",   "type": int,  "optional": True, "default": 300},
+        {"name": "replica",                  "type": bool, "optional": True, "default": False},
+        {"name": "replica_poll_interval_ms", "type": int,  "optional": True, "default": 100},
+        {"name": "shards",                   "type": str,  "optional": True, "default": ""},
+        {"name": "shard_base_port",          "type": int,  "optional": True, "default": 8911},
+        {"name": "rate_limit",               "type": bool, "optional": True, "default": True},
+        {"name": "rate_limits",              "type": dict, "optional": True, "default": {}},
+        {"name": "rate_limit_file",          "type": str,  "optional": True, "default": "rate_limit.table"},
+        {"name": "rate_limit_slots",         "type": int,  "optional": True, "default": 65536},
+]
+
+def settings_file():
+    """The path of the settings file: server.json, unless another one is given
+    in the environment variable CYBERLAND_SETTINGS, so that processes started
+    from the same directory can have different settings."""
+    return os.environ.get("CYBERLAND_SETTINGS", "server.json")
+
+def default_settings():
+    "Returns the server settings used when no settings file is given."
+    return format_fields({}, settings_fields)[1]
+
+def read_settings_file(filename):
+    """Reads the server settings file. If the file does not exist, the default
+    settings are used. Returns a boolean telling that no error happened and
+    the dictionary of settings."""
+    try:
+        dic = json_to_dic(filename)
+    except FileNotFoundError:
+        return True, default_settings()
+    settings_OK, settings, error_msg = format_fields(dic, settings_fields)
+    if not settings_OK:
+        print("Error in server settings:\n"+error_msg)
+    return settings_OK, settings
+
 # ----------------------------------- Test ----------------------------------- #
 
 if __name__ == '__main__':
     print(json_to_dic("config.json"))
     print("\n--------------\n")
     print(format_server_config(json_to_dic("config.json")))
+    print("\n--------------\n")
+    print(read_settings_file(settings_file()))
 
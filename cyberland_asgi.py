@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+This file contains the asynchronous serving mode of the server, as an ASGI
+application. It serves the same routes as cyberland.py, but long polls and
+streams wait for new posts without holding a thread, so one process can
+serve many concurrent pollers. The disk writes are made by a background
+writer and the work that can block is made out of the event loop.
+It needs an ASGI server, such as uvicorn:
+    uvicorn cyberland_asgi:app --port 8901
+"""
+
+import asyncio
+import mimetypes
+import os
+import sys
+import time
+from urllib.parse import parse_qs
+from jinja2 import Environment, FileSystemLoader
+from config import read_config_file, read_settings_file, settings_file, select_boards, server_options
+from api import API, Client, Reply, STREAM_HEADERS, KEEP_ALIVE
+from writer import BackgroundWriter
+import metrics
+
+# -------------------------- Preparing server's state ------------------------ #
+
+boards, port = server_options(__name__ == '__main__')
+config_OK, server_config = read_config_file("config.json")
+if not config_OK:
+    print("Unable to read configuration.")
+    sys.exit(1)
+# Each worker of the sharded mode only serves some boards
+boards_OK, server_config = select_boards(server_config, boards)
+if not boards_OK:
+    print("Unable to select the boards served.")
+    sys.exit(1)
+settings_OK, settings = read_settings_file(settings_file())
+if not settings_OK:
+    print("Unable to read server settings.")
+    sys.exit(1)
+writer = BackgroundWriter()
+api = API(server_config, settings, writer)
+db = api.db
+
+# The files used by the root page are next to this one, like with Flask
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(ROOT_DIR, "static")
+templates = Environment(loader=FileSystemLoader(os.path.join(ROOT_DIR, "templates")), autoescape=True)
+templates.globals["url_for"] = lambda endpoint, filename: "/" + endpoint + "/" + filename
+
+# With the SQLite backend, or with archived posts read from their segments,
+# reading a board can wait for the disk
+READS_BLOCK = settings["backend"] != "json" or settings["hot_posts"] > 0
+
+class PostWaiter:
+    """Lets coroutines wait for new posts. New posts are made in other
+    threads, which wake the waiting coroutines through the event loop. The
+    boards are also checked every second, for posts made by other processes."""
+    def __init__(self, boards):
+        self.loop = None
+        self.events = {board: asyncio.Event() for board in boards}
+
+    def attach(self, loop):
+        "Sets the event loop of the waiting coroutines."
+        self.loop = loop
+
+    def notify(self, board, post):
+        "Listener of the database, called in the thread making the post."
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wake, board)
+
+    def wake(self, board):
+        self.events[board].set()
+        self.events[board] = asyncio.Event()
+
+    async def wait(self, board, since, timeout, thread=None):
+        """Waits until a post with an ID greater than since is made, in the
+        given thread if any, or until timeout seconds passed. Returns True if
+        there is such a post."""
+        deadline = self.loop.time() + timeout
+        while not await run_read(db.has_new_post, board, since, thread):
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self.events[board].wait(), min(remaining, 1))
+            except asyncio.TimeoutError:
+                pass
+        return True
+
+waiter = PostWaiter(db.boards())
+db.add_listener(waiter.notify)
+
+async def run_blocking(function, *args):
+    "Runs a function that can block in a thread, out of the event loop."
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+async def run_read(function, *args):
+    "Runs a function reading the database, out of the event loop if it can block."
+    if READS_BLOCK:
+        return await run_blocking(function, *args)
+    return function(*args)
+
+# ---------------------------------- Requests --------------------------------- #
+
+def query_args(scope):
+    "The parameters of a request, keeping the first value of each one."
+    args = parse_qs(scope["query_string"].decode("latin-1"), keep_blank_values=True)
+    return {k: v[0] for k, v in args.items()}
+
+def request_headers(scope):
+    return {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body", False):
+            return body
+
+async def wait_disconnect(receive):
+    "Returns once the client closed the connection."
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+def content_type(mimetype):
+    if mimetype.startswith("text/"):
+        mimetype += "; charset=utf-8"
+    return mimetype.encode("latin-1")
+
+def start_message(status, mimetype, headers, length=None):
+    raw_headers = [(b"content-type", content_type(mimetype)), (b"access-control-allow-origin", b"*")]
+    if length is not None:
+        raw_headers.append((b"content-length", str(length).encode("latin-1")))
+    for header in headers:
+        raw_headers.append((header.lower().encode("latin-1"), headers[header].encode("latin-1")))
+    return {"type": "http.response.start", "status": status, "headers": raw_headers}
+
+async def send_reply(send, reply):
+    body = reply.body if isinstance(reply.body, bytes) else reply.body.encode("UTF-8")
+    await send(start_message(reply.status, reply.mimetype, reply.headers, len(body)))
+    await send({"type": "http.response.body", "body": body})
+
+# ------------------------------- Default pages ------------------------------ #
+
+async def root():
+    page = templates.get_template("index.html").render(example_board = api.example_board())
+    return Reply(page)
+
+async def static_file(filename):
+    path = os.path.join(STATIC_DIR, filename)
+    if filename.startswith(".") or not os.path.isfile(path):
+        return NOT_FOUND
+    with open(path, "rb") as f:
+        body = await run_blocking(f.read)
+    return Reply(body, mimetype=mimetypes.guess_type(path)[0] or "application/octet-stream")
+
+NOT_FOUND = Reply("Not Found", 404)
+METHOD_NOT_ALLOWED = Reply("Method Not Allowed", 405)
+
+# Pages by path, with the name of the route used in the metrics, the same as with Flask
+PAGES = {
+        "tut.txt":    ("tut_txt",     lambda: run_blocking(api.txt, "tut.txt")),
+        "banner.txt": ("banner_txt",  lambda: run_blocking(api.txt, "banner.txt")),
+        "config":     ("get_config",  lambda: run_read(api.config)),
+        "status":     ("get_lengths", lambda: run_read(api.status)),
+        "length":     ("get_lengths", lambda: run_read(api.status)),
+        "boards":     ("get_boards",  lambda: run_read(api.boards)),
+        "metrics":    ("get_metrics", lambda: run_read(api.metrics_page)),
+}
+
+# --------------------------------- REST API --------------------------------- #
+
+async def posting(board, scope, receive):
+    form = parse_qs((await read_body(receive)).decode("UTF-8", "replace"), keep_blank_values=True)
+    form = {k: v[0] for k, v in form.items()}
+    headers = request_headers(scope)
+    client = Client(scope["client"][0] if scope.get("client") else None, headers.get("x-real-ip"))
+    # The anti-spam and the database can wait for the disk
+    return await run_blocking(api.post, board, form, client)
+
+async def reading(board, scope):
+    error, read = api.parse_read(board, query_args(scope))
+    if error is not None:
+        return error
+    # Holding long polls until there is something new
+    if read["wait"] > 0:
+        await waiter.wait(board, read["since"], read["wait"], read["thread"])
+    return await run_read(api.read, read, request_headers(scope).get("if-none-match"))
+
+async def streaming(board, scope, receive, send):
+    """Sends the new posts of a board as Server-Sent Events until the client
+    closes the connection."""
+    args = query_args(scope)
+    error, since = api.parse_stream(board, args.get('since', request_headers(scope).get('last-event-id')))
+    if error is not None:
+        await send_reply(send, error)
+        return
+
+    await send(start_message(200, "text/event-stream", STREAM_HEADERS))
+    disconnect = asyncio.ensure_future(wait_disconnect(receive))
+    try:
+        while True:
+            new_events, since = await run_read(api.stream_events, board, since)
+            if new_events:
+                await send({"type": "http.response.body", "body": "".join(new_events).encode("UTF-8"), "more_body": True})
+            new_post = asyncio.ensure_future(waiter.wait(board, since, settings["long_poll_max_s"]))
+            await asyncio.wait([new_post, disconnect], return_when=asyncio.FIRST_COMPLETED)
+            if disconnect.done():
+                new_post.cancel()
+                return
+            if not new_post.result():
+                await send({"type": "http.response.body", "body": KEEP_ALIVE.encode("UTF-8"), "more_body": True})
+    finally:
+        disconnect.cancel()
+
+# ---------------------------------- Routing --------------------------------- #
+
+async def app(scope, receive, send):
+    "The ASGI application."
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    waiter.attach(asyncio.get_running_loop())
+    start = time.perf_counter()
+
+    # Routes are matched with or without their trailing slash
+    method = scope["method"]
+    parts = scope["path"].strip("/").split("/")
+    route = "not_found"
+    remote_addr = scope["client"][0] if scope.get("client") else None
+    real_ip = request_headers(scope).get("x-real-ip")
+    # The shared table of the rate limiter is locked for a few microseconds
+    refused = api.admit(remote_addr, real_ip, method, scope["path"])
+    if refused is not None:
+        reply = refused
+    elif method == "OPTIONS":
+        reply = Reply("", 200, headers={
+                "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+                "Access-Control-Allow-Headers": request_headers(scope).get("access-control-request-headers", "*")})
+    elif parts == [""]:
+        route = "root"
+        reply = await root() if method in ("GET", "HEAD") else METHOD_NOT_ALLOWED
+    elif len(parts) == 2 and parts[0] == "static":
+        route = "static"
+        reply = await static_file(parts[1]) if method in ("GET", "HEAD") else METHOD_NOT_ALLOWED
+    elif len(parts) == 1 and parts[0] in PAGES and method in ("GET", "HEAD"):
+        route, page = PAGES[parts[0]]
+        reply = await page()
+    elif parts == ["batch"] and method == "POST":
+        route = "batching"
+        body = await read_body(receive)
+        reply = await run_read(api.batch, body)
+    elif len(parts) == 1 and method == "POST":
+        route = "posting"
+        reply = await posting(parts[0], scope, receive)
+    elif len(parts) == 1 and method in ("GET", "HEAD"):
+        route = "reading"
+        reply = await reading(parts[0], scope)
+    elif len(parts) == 1:
+        reply = METHOD_NOT_ALLOWED
+    elif len(parts) == 2 and parts[1] == "catalog":
+        route = "cataloging"
+        if method not in ("GET", "HEAD"):
+            reply = METHOD_NOT_ALLOWED
+        else:
+            reply = await run_read(api.catalog, parts[0], query_args(scope), request_headers(scope).get("if-none-match"))
+    elif len(parts) == 2 and parts[1] == "search":
+        route = "searching"
+        if method not in ("GET", "HEAD"):
+            reply = METHOD_NOT_ALLOWED
+        else:
+            reply = await run_read(api.search, parts[0], query_args(scope), request_headers(scope).get("if-none-match"))
+    elif len(parts) == 2 and parts[1] == "stream":
+        if method != "GET":
+            reply = METHOD_NOT_ALLOWED
+        else:
+            # Streams are counted once started
+            metrics.request_done("streaming", method, 200, time.perf_counter() - start)
+            await streaming(parts[0], scope, receive, send)
+            return
+    else:
+        reply = NOT_FOUND
+    headers = request_headers(scope)
+    reply = await run_read(api.compress, reply, headers.get("accept-encoding"), headers.get("if-none-match"))
+    await send_reply(send, reply)
+    metrics.request_done(route, method, reply.status, time.perf_counter() - start)
+    api.charge(remote_addr, real_ip, method, scope["path"], reply.posts)
+
+async def lifespan(receive, send):
+    "Attaches the waiter to the event loop and flushes the writes on shutdown."
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            waiter.attach(asyncio.get_running_loop())
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await run_blocking(api.post_log.flush)
+            await run_blocking(writer.flush)
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+# ---------------------------- Running the server ---------------------------- #
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        print("The asynchronous mode needs uvicorn, or can be run by any other ASGI server.")
+        sys.exit(1)
+    uvicorn.run(app, port = port)
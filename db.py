@@ -1,91 +1,1096 @@
 #!/usr/bin/env python3
 """
 This file contains what is needed to interact with the database of all posts.
-As of now, for testing purpose, the posts are stored in RAM and backed-up in a
-JSON file. But this will have to be replaced with a proper database in the future.
+The posts are kept by a storage backend chosen in the server settings. The
+default one stores the posts in RAM and backs them up in JSON files. The
+SQLite one, in db_sqlite.py, is meant for boards bigger than the RAM.
 """
 
+import re
 import json
+import os
+import sys
+import shutil
+import mmap
 import time
+import struct
 import datetime
+import threading
+import metrics
+from catalog import Catalog
+from search import SearchIndex
+from segments import Segments, SegmentCache
+from array import array
+from collections import namedtuple
+from bisect import bisect_left, bisect_right
+from config import default_settings
+
+# What is found between the elements of a JSON array
+SEPARATORS = re.compile(r"[\s,]*")
+ELEMENT_SEPARATOR = re.compile(r"\s*,")
+
+# Content of the posts erased by the moderators
+ERASED_CONTENT = "[removed]"
+
+# Number of posts read at once when the catalogs are updated from the storage
+CATALOG_CHUNK = 65536
+
+# Number of posts read at once when the search indexes are updated from the storage
+SEARCH_CHUNK = 4096
+
+# Binary snapshots of the boards start with their format, their version, the
+# number of posts and erased posts, the size of the contents and the number
+# of posts whose contents are archived in segments, which the version 1 lacks
+SNAPSHOT_MAGIC = b"CYBSNAP\n"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct("<8sIQQQQ")
+SNAPSHOT_HEADER_V1 = struct.Struct("<8sIQQQ")
+# Bytes of contents written at once, so that the buffer is never copied whole
+SNAPSHOT_CHUNK = 1 << 20
 
 class DataBase:
-    """The database containing all the posts. As of now, for testing purpuse,
-    it is only an humble JSON file"""
-    def __init__(self, server_config, db_dir):
+    """The database containing all the posts. It only checks the new posts
+    and leaves the storage to its backend. The posts of a board are made one
+    at a time, and the backend gives them their ID while making sure no other
+    process sharing the storage took it. If a background writer is given,
+    the backends that can make their disk writes later leave them to it."""
+    def __init__(self, server_config, db_dir, settings=None, writer=None):
+        if settings is None:
+            settings = default_settings()
+        if settings["replica"] and settings["backend"] != "json":
+            raise ValueError("Replicas need the json backend.")
+        if settings["backend"] == "json":
+            self.store = JSONStore(server_config, db_dir, settings, writer)
+        elif settings["backend"] == "sqlite":
+            from db_sqlite import SQLiteStore
+            self.store = SQLiteStore(server_config, db_dir, settings)
+        else:
+            raise ValueError("Unknown storage backend " + settings["backend"] + ".")
+        self.listeners = []
+        self.locks = {board: threading.Lock() for board in self.store.boards()}
+        self.conditions = {board: threading.Condition() for board in self.store.boards()}
+        self.erasures = {board: 0 for board in self.store.boards()}
+        self.catalogs = {}
+        for board in self.store.boards():
+            self.catalogs[board] = Catalog(settings["catalog_preview_size"])
+            self.update_catalog(board)
         self.db_dir = db_dir
-        self.db = {}
+        self.search_indexes = {}
+        if settings["search"]:
+            for board in self.store.boards():
+                self.search_indexes[board] = self.load_search_index(board)
+                self.update_search_index(board)
+            # The primary saves the indexes, replicas only read them
+            if not settings["replica"]:
+                saver = threading.Thread(target=self.save_search_indexes, args=(settings["search_save_interval_s"],), daemon=True)
+                saver.start()
+        if settings["replica"]:
+            follower = threading.Thread(target=self.follow_primary, args=(settings["replica_poll_interval_ms"],), daemon=True)
+            follower.start()
 
-        # Reading db files
-        for k in server_config.keys():
-            try:
-                with open(db_dir + "/" + k + ".json", "r") as db_f:
-                    self.db[k] = json.load(db_f)
-            except FileNotFoundError: # New board
-                self.db[k] = [{"id": 0, "time": 0, "replyTo": 0, "content": server_config[k]["description"], "bumpCount": 1}]
+    def __str__(self):
+        return str(self.store)
 
-    def update_db(self, board):
-        "Update the db JSON file with new content from the internal DB."
-        with open(self.db_dir + "/" + board + ".json", "w") as db_f:
-            json_str = json.dumps(self.db[board])
-            db_f.write(json_str)
+    def boards(self):
+        "Returns the name of all the boards."
+        return self.store.boards()
 
-    def __str__(self):
-        return str(self.db)
+    def post_count(self, board):
+        "Returns the number of posts in a board."
+        return self.store.count(board)
+
+    def version(self, board):
+        """Returns a value that changes each time a board is modified. As
+        posts are never removed, the number of posts is enough, followed by
+        the number of posts erased by this process if there are some."""
+        count = self.store.count(board)
+        if self.erasures[board] == 0:
+            return count
+        return str(count) + "." + str(self.erasures[board])
+
+    def add_listener(self, listener):
+        "Registers a function called with the board and the post of each new post."
+        self.listeners.append(listener)
 
     def next_id(self, board):
         "Return the next valid ID for a board"
-        return len(self.db[board])
+        return self.store.count(board)
 
     def new_post(self, board, post):
-        "Tries to append a new post to a board. If it can be done, return True."
-        if len(self.db[board]) == post["id"]:
-            if post["replyTo"] >= len(self.db[board]):
-                return False
-            self.db[board].append(post)
+        """Tries to append a new post to a board. If it can be done, return True.
+        If the ID of the post is None, the next valid ID is given to it."""
+        with self.locks[board]:
             post["time"] = now_utc_unix()
-            self.db[board][post["replyTo"]]["bumpCount"] += 1
-            self.update_db(board)
-            return True
-        else:
-            return False
+            if not self.store.append(board, post):
+                return False
+            if self.catalogs[board].count == post["id"]:
+                self.catalogs[board].add(post["id"], post["replyTo"])
+            else:
+                self.update_catalog(board) # Other processes posted too
+            if board in self.search_indexes:
+                if self.search_indexes[board].count == post["id"]:
+                    self.search_indexes[board].add(post["id"], post["content"])
+                else:
+                    self.update_search_index(board)
+            # Listeners are called while holding the lock so that they see the posts in order
+            for listener in self.listeners:
+                listener(board, post)
+        with self.conditions[board]:
+            self.conditions[board].notify_all()
+        return True
+
+    def follow_primary(self, interval_ms):
+        """Regularly adds the posts made by the primary to a replica. The
+        listeners are called for them as for new posts."""
+        while True:
+            time.sleep(interval_ms / 1000)
+            for board in self.boards():
+                with self.locks[board]:
+                    posts = self.store.follow(board)
+                    for post in posts:
+                        for listener in self.listeners:
+                            listener(board, post)
+                if posts:
+                    with self.conditions[board]:
+                        self.conditions[board].notify_all()
 
     def auto_post(self, board, content, replyTo):
         """Make a new post with a comment and a replyTo and automatically choose the
         right ID. Returns the same value as new_post with the added post ID."""
-        id = self.next_id(board)
-        post = {"id": id, "content": content, "replyTo": replyTo, "bumpCount": 0}
-        return self.new_post(board, post), id
-
-    def get_last_posts(self, board, num):
-        "Reads the db to find the last few posts."
-        if num > len(self.db[board]):
-            num = len(self.db[board])
-        reply = []
-        for i in range(len(self.db[board])-1, len(self.db[board])-num-1, -1):
-            reply.append(self.db[board][i])
-        return reply
+        post = {"id": None, "content": content, "replyTo": replyTo, "bumpCount": 0}
+        return self.new_post(board, post), post["id"]
+
+    def update_catalog(self, board):
+        """Adds to the catalog of a board the posts it misses, made by other
+        processes sharing the storage. Must be called holding the lock of the
+        board."""
+        catalog = self.catalogs[board]
+        count = self.store.count(board)
+        while catalog.count < count:
+            end = min(count, catalog.count + CATALOG_CHUNK)
+            catalog.add_all(catalog.count, self.store.reply_tos(board, catalog.count, end))
+
+    def get_catalog(self, board, num, offset):
+        """Returns the OPs of num threads ordered by their last bump, most
+        recent first, skipping the offset first ones. Each OP has the list of
+        its last replies, oldest first, in the field lastReplies."""
+        with self.locks[board]:
+            self.update_catalog(board)
+            page = self.catalogs[board].page(num, offset)
+        ret = []
+        for id, replies in page:
+            OP = self.store.get(board, id)
+            OP["lastReplies"] = [self.store.get(board, reply) for reply in replies]
+            ret.append(OP)
+        return ret
+
+    # --------------------------------- Search --------------------------------- #
+
+    def search_file(self, board):
+        "Path of the saved search index of a board."
+        return self.db_dir + "/" + board + ".search"
+
+    def load_search_index(self, board):
+        """Reads the saved search index of a board. A new index is made if
+        there is none or if it covers posts the board does not have."""
+        index = SearchIndex.read(self.search_file(board))
+        if index is None or index.count > self.store.count(board):
+            return SearchIndex()
+        return index
+
+    def update_search_index(self, board):
+        """Adds to the search index of a board the posts it misses, made
+        before it was saved or by other processes sharing the storage. Must
+        be called holding the lock of the board, except at startup."""
+        index = self.search_indexes[board]
+        count = self.store.count(board)
+        while index.count < count:
+            end = min(count, index.count + SEARCH_CHUNK)
+            index.add_all(index.count, self.store.contents(board, index.count, end))
+
+    def save_search_indexes(self, interval_s):
+        "Regularly saves the search indexes that changed since they were last saved."
+        saved = {}
+        while True:
+            time.sleep(interval_s)
+            for board, index in self.search_indexes.items():
+                if saved.get(board) == index.count:
+                    continue
+                with self.locks[board]:
+                    count, postings = index.snapshot()
+                SearchIndex.write(self.search_file(board), count, postings)
+                saved[board] = count
+
+    def search(self, board, tokens, num, offset=0, before=None, since=None):
+        """Returns the posts containing all the tokens, the one with the
+        greatest ID first, with the same paging as get_last_posts: the offset
+        last ones are skipped, before and since bound the IDs and replace the
+        offset, and when only since is given the posts right after it are
+        returned. Erased posts are left out and not counted in num and offset.
+        Returns None if the search is disabled."""
+        if board not in self.search_indexes:
+            return None
+        with self.locks[board]:
+            self.update_search_index(board)
+            ids = self.search_indexes[board].search(tokens, num, offset, before, since,
+                    lambda id: self.store.contents(board, id, id + 1)[0] == ERASED_CONTENT)
+        posts = [self.store.get(board, id) for id in ids]
+        # A post can be erased by another process once the lock is released
+        return [post for post in posts if post["content"] != ERASED_CONTENT]
+
+    def erase(self, board, id):
+        """Replaces the content of a post by ERASED_CONTENT. Returns True if
+        the post exists. The version of the board changes even if the post was
+        already erased by another process, as this one may have cached it."""
+        with self.locks[board]:
+            if not 0 <= id < self.store.count(board):
+                return False
+            self.store.erase(board, id)
+            self.erasures[board] += 1
+        return True
+
+    def get_last_posts(self, board, num, offset=0, before=None, since=None):
+        """Reads the db to find the last few posts, the one with the greatest
+        ID first, skipping the offset last ones. If before is given, only the
+        posts with a smaller ID are considered and offset is ignored. If since
+        is given, only the posts with a greater ID are considered. The posts
+        are found directly from their IDs, whatever the offset."""
+        if before is None:
+            before = self.store.count(board) - offset
+        return self.store.last(board, num, before, since)
 
     def get_post(self, board, id):
         """Returns a specific post by its ID.
         Also returns a boolean telling if the search was successful."""
+        post = self.store.get(board, id)
+        return post, post is not None
+
+    def get_first_replies(self, board, num, id, offset=0, since=None, before=None):
+        """Return the first few post replying to an other post, skipping the
+        first offset ones. If num is negative, all the replies are returned.
+        If since is given, only the replies with a greater ID are considered.
+        If before is given, the last few replies with a smaller ID are
+        returned instead, still sorted by increasing ID, and offset is ignored."""
+        return self.store.replies(board, num, id, offset, since, before)
+
+    def get_posts_since(self, board, since, num):
+        """Returns the first few posts with an ID greater than since. As with
+        get_last_posts, the post with the greatest ID is the first one."""
+        return self.store.since(board, since, num)
+
+    def has_new_post(self, board, since, thread=None):
+        "Tells if there is a post with an ID greater than since, in the given thread if any."
+        if thread is None:
+            return self.store.count(board) > since + 1
+        return len(self.store.replies(board, 1, thread, 0, since)) != 0
+
+    def wait_for_post(self, board, since, timeout, thread=None):
+        """Waits until a post with an ID greater than since is made, in the
+        given thread if any, or until timeout seconds passed. Returns True if
+        there is such a post. The board is also checked every second as posts
+        can be made by other processes sharing the storage."""
+        deadline = time.monotonic() + timeout
+        with self.conditions[board]:
+            while not self.has_new_post(board, since, thread):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.conditions[board].wait(min(remaining, 1))
+        return True
+
+# ------------------------------- JSON backend ------------------------------- #
+
+class JSONStore:
+    """Storage backend keeping all the posts in RAM, in compact Board
+    objects. Each board is backed up in a JSON file, optionally followed by a
+    journal of the newer posts. With a background writer, the files are
+    written after the posts are accepted. With a hot window, the contents of
+    the older posts are archived in segments. A replica never writes its
+    files: it reads the boards from the snapshots and the segments of its
+    primary and follows its journals."""
+    def __init__(self, server_config, db_dir, settings, writer=None):
+        self.server_config = server_config
+        self.db_dir = db_dir
+        self.writer = writer
+        self.db = {}
+        self.threads = {}
+        self.journals = {}
+        self.replica = settings["replica"]
+        self.tails = {}
+        self.pending = {}
+        self.locks = {}
+        self.compacting = set()
+        self.compaction_threshold = settings["compaction_threshold"]
+        self.archiving = set()
+        self.hot_posts = settings["hot_posts"]
+        self.segment_posts = settings["segment_posts"]
+        self.segment_cache = SegmentCache(settings["segment_cache_mb"] * 1024 * 1024)
+        if self.segment_posts <= 0:
+            raise ValueError("Segments must hold at least one post.")
+        self.snapshot_format = settings["snapshot_format"]
+        if self.snapshot_format not in ("binary", "json"):
+            raise ValueError("Unknown snapshot format " + self.snapshot_format + ".")
+
+        # Reading db files
+        for k in server_config.keys():
+            self.locks[k] = threading.Lock()
+            self.db[k], loaded_format = self.load_board(k, server_config[k])
+            if self.replica:
+                self.tails[k] = JournalTail(self.journal_file(k))
+                self.pending[k] = []
+            elif settings["journal"]:
+                self.open_journal(k, settings)
+            else:
+                self.fold_journals(k)
+            self.index_threads(k)
+            if self.replica:
+                self.follow(k)
+            # Converted right away so that the next start is fast
+            elif loaded_format == "json" and self.snapshot_format == "binary":
+                self.update_db(k)
+            if not self.replica:
+                self.archive_if_needed(k)
+
+        if self.replica:
+            return
+        if settings["journal"]:
+            flusher = threading.Thread(target=self.flush_journals, args=(settings["journal_fsync_interval_ms"],), daemon=True)
+            flusher.start()
+        if self.snapshot_format == "binary" and settings["json_export_interval_s"] > 0:
+            exporter = threading.Thread(target=self.export_json, args=(settings["json_export_interval_s"],), daemon=True)
+            exporter.start()
+
+    def __str__(self):
+        return str({k: str(self.db[k]) for k in self.db})
+
+    def board_file(self, board):
+        "Path of the full JSON snapshot of a board."
+        return self.db_dir + "/" + board + ".json"
+
+    def snapshot_file(self, board):
+        "Path of the full binary snapshot of a board."
+        return self.db_dir + "/" + board + ".snap"
+
+    def segments_dir(self, board):
+        "Path of the directory of the archived segments of a board."
+        return self.db_dir + "/" + board + ".segments"
+
+    def load_board(self, board, board_config):
+        """Reads a board from the newest of its snapshots, the binary one if
+        both are as old. Returns the board and the format it was read from."""
+        segments = Segments(self.segments_dir(board), self.segment_cache)
+        if newest_snapshot(self.board_file(board), self.snapshot_file(board)) == "binary":
+            return Board.from_snapshot(self.snapshot_file(board), segments), "binary"
+        try:
+            with open(self.board_file(board), "r") as db_f:
+                loaded, loaded_format = Board.from_posts(iter_json_array(db_f)), "json"
+        except FileNotFoundError: # New board
+            loaded, loaded_format = Board.from_posts([first_post(board_config)]), None
+        loaded.segments = segments
+        return loaded, loaded_format
+
+    def write_board(self, board, bumps=None):
+        "Writes the snapshot of a board in the format of the settings. Returns its size."
+        if self.snapshot_format == "binary":
+            return self.db[board].write_snapshot(self.snapshot_file(board), bumps)
+        return self.db[board].write_json(self.board_file(board), bumps)
+
+    def export_json(self, interval_s):
+        """Regularly writes the JSON files of the boards that changed, for the
+        tools reading them, when the boards are stored in binary snapshots.
+        The export is dated like the binary snapshot so that it is never
+        loaded instead of it."""
+        exported = {}
+        while True:
+            time.sleep(interval_s)
+            for board in self.boards():
+                with self.locks[board]:
+                    count = len(self.db[board])
+                    bumps = self.db[board].bumps[:count]
+                if exported.get(board) == count:
+                    continue
+                start = time.perf_counter()
+                size = self.db[board].write_json(self.board_file(board), bumps)
+                metrics.write_done(board, "json_export", time.perf_counter() - start, size)
+                try:
+                    snapshot_mtime = os.stat(self.snapshot_file(board)).st_mtime_ns
+                    os.utime(self.board_file(board), ns=(snapshot_mtime, snapshot_mtime))
+                except FileNotFoundError:
+                    pass
+                exported[board] = count
+
+    def index_threads(self, board):
+        "Builds the index from each post to the list of IDs of its replies."
+        self.threads[board] = {}
+        reply_to = self.db[board].reply_to
+        for id in range(1, len(reply_to)):
+            self.index_reply(board, id, reply_to[id])
+
+    def index_reply(self, board, id, replyTo):
+        "Adds a post at the end of the list of replies of its parent."
         try:
-            if self.db[board][id]["id"] == id: # Everything is well
-                return self.db[board][id], True
+            self.threads[board][replyTo].append(id)
+        except KeyError:
+            self.threads[board][replyTo] = array("q", [id])
+
+    def update_db(self, board):
+        "Update the db snapshot file with new content from the internal DB."
+        start = time.perf_counter()
+        size = self.write_board(board)
+        metrics.write_done(board, "update_db", time.perf_counter() - start, size)
+
+    def write(self, job, *args, key=None):
+        "Makes a disk write, through the background writer if there is one."
+        if self.writer is None:
+            job(*args)
+        else:
+            self.writer.submit(job, *args, key=key)
+
+    def boards(self):
+        return list(self.db.keys())
+
+    def count(self, board):
+        return len(self.db[board])
+
+    def append(self, board, post):
+        """Appends the post if its ID is the next one of the board and if it
+        replies to an existing post. A post without ID gets the next one."""
+        if self.replica:
+            return False
+        with self.locks[board]:
+            count = len(self.db[board])
+            if post["id"] is None:
+                post["id"] = count
+            if post["id"] != count or post["replyTo"] >= count:
+                return False
+            self.db[board].append(post["replyTo"], post["time"], post["content"])
+            self.db[board].bump(post["replyTo"])
+            self.index_reply(board, post["id"], post["replyTo"])
+            self.archive_if_needed(board)
+            if board in self.journals:
+                journal = self.journals[board]
+                self.write(journal.append, post)
+                if journal.count >= self.compaction_threshold and board not in self.compacting:
+                    self.compacting.add(board)
+                    threading.Thread(target=self.compact, args=(board,), daemon=True).start()
             else:
-                raise IndexError # Force a pass in the except block
-        except IndexError:
-            return None, False
+                self.write(self.update_db, board, key=("update_db", board))
+        return True
 
-    def get_first_replies(self, board, num, id):
-        "Return the first few post replying to an other post."
-        ret = []
-        for i in self.db[board][id+1:-1]:
-            if i["replyTo"] == id:
-                ret.append(i)
-                if len(ret) == num:
+    def erase(self, board, id):
+        with self.locks[board]:
+            if id in self.db[board].erased:
+                return
+            self.db[board].erase(id)
+            if board not in self.journals and not self.replica:
+                self.write(self.update_db, board, key=("update_db", board))
+
+    def reply_tos(self, board, start, end):
+        return self.db[board].reply_to[start:end]
+
+    def contents(self, board, start, end):
+        return [self.db[board].content(i) for i in range(start, end)]
+
+    def last(self, board, num, before, since=None):
+        board = self.db[board]
+        end = max(min(before, len(board)), 0)
+        start = max(end - max(num, 0), 0 if since is None else since + 1)
+        return [board.post(i) for i in range(end-1, start-1, -1)]
+
+    def get(self, board, id):
+        if 0 <= id < len(self.db[board]):
+            return self.db[board].post(id)
+        return None
+
+    def replies(self, board, num, id, offset, since=None, before=None):
+        replies = self.threads[board].get(id, [])
+        start = 0 if since is None else bisect_right(replies, since)
+        if before is not None:
+            end = bisect_left(replies, before)
+            if num >= 0:
+                start = max(start, end - num)
+            return [self.db[board].post(i) for i in replies[start:end]]
+        offset += start
+        if num < 0:
+            ids = replies[offset:]
+        else:
+            ids = replies[offset:offset+num]
+        return [self.db[board].post(i) for i in ids]
+
+    def since(self, board, since, num):
+        board = self.db[board]
+        end = min(len(board), since + 1 + num)
+        return [board.post(i) for i in range(end-1, max(since, -1), -1)]
+
+    # --------------------------------- Journal -------------------------------- #
+
+    def journal_file(self, board):
+        "Path of the journal of posts made since the last snapshot."
+        return self.db_dir + "/" + board + ".journal"
+
+    def open_journal(self, board, settings):
+        """Replays the journal of a board on top of its snapshot and opens it
+        to append new posts. If a compaction was interrupted, its journal is
+        replayed too and the compaction is finished right away."""
+        old_journal = self.journal_file(board) + ".old"
+        interrupted = os.path.exists(old_journal)
+        if interrupted:
+            self.replay_journal(board, old_journal)
+        self.replay_journal(board, self.journal_file(board))
+        self.journals[board] = Journal(self.journal_file(board), settings["journal_fsync_every"])
+        if interrupted:
+            self.compacting.add(board)
+            self.compact(board)
+
+    def fold_journals(self, board):
+        """Without the journal setting, replays the journals left by a server
+        that had it and folds them into the snapshot of the board, so that
+        their posts are not lost when the snapshot is next written."""
+        journals = [path for path in (self.journal_file(board) + ".old", self.journal_file(board)) if os.path.exists(path)]
+        if not journals:
+            return
+        for path in journals:
+            self.replay_journal(board, path)
+        self.update_db(board)
+        for path in journals:
+            os.remove(path)
+
+    def replay_journal(self, board, path):
+        """Adds the posts of a journal file that are not yet in the board. A
+        truncated last record, left by a crash, is removed from the file."""
+        try:
+            f = open(path, "r+b")
+        except FileNotFoundError:
+            return
+        with f:
+            valid_size = 0
+            for line in f:
+                if not line.endswith(b"\n"):
                     break
-        return ret
+                post = json.loads(line)
+                valid_size += len(line)
+                if post["id"] < len(self.db[board]):
+                    continue # Already in the snapshot
+                if post["id"] != len(self.db[board]):
+                    raise ValueError("Gap in the journal " + path + " at id " + str(post["id"]))
+                self.db[board].append(post["replyTo"], post["time"], post["content"])
+                self.db[board].bump(post["replyTo"])
+            f.truncate(valid_size)
+
+    def compact(self, board):
+        """Folds the journal of a board back into its snapshot. Only the
+        capture of the board is made while holding its lock, the snapshot is
+        written while new posts keep being appended to a fresh journal."""
+        old_journal = self.journal_file(board) + ".old"
+        try:
+            with self.locks[board]:
+                count = len(self.db[board])
+                bumps = self.db[board].bumps[:count]
+                self.journals[board].rotate(old_journal)
+            start = time.perf_counter()
+            size = self.write_board(board, bumps)
+            metrics.write_done(board, "compaction", time.perf_counter() - start, size)
+            os.remove(old_journal)
+        finally:
+            self.compacting.discard(board)
+
+    # -------------------------------- Archiving ------------------------------- #
+
+    def archive_if_needed(self, board):
+        """Starts archiving the posts of a board that are out of its hot
+        window, once there are enough of them to fill a segment."""
+        if self.hot_posts <= 0 or board in self.archiving:
+            return
+        if len(self.db[board]) - self.db[board].archived >= self.hot_posts + self.segment_posts:
+            self.archiving.add(board)
+            threading.Thread(target=self.archive, args=(board,), daemon=True).start()
+
+    def archive(self, board):
+        """Moves the contents of the posts out of the hot window of a board to
+        segments, one segment at a time. Only the copy of the contents and
+        the swap of the buffers are made while holding the lock of the board,
+        the segments are compressed and written while posts keep coming. The
+        snapshots only tell the posts are archived once they are written
+        again."""
+        try:
+            while True:
+                with self.locks[board]:
+                    loaded = self.db[board]
+                    first_id = loaded.archived
+                    end_id = first_id + self.segment_posts
+                    if len(loaded) - end_id < self.hot_posts:
+                        return
+                    start = loaded.offsets[first_id]
+                    data = bytes(loaded.raw_contents(start, loaded.offsets[end_id]))
+                begin = time.perf_counter()
+                size = loaded.segments.write(first_id, end_id, start, data)
+                metrics.write_done(board, "archive", time.perf_counter() - begin, size)
+                with self.locks[board]:
+                    loaded.archive(end_id)
+        finally:
+            self.archiving.discard(board)
+
+    # --------------------------------- Replica -------------------------------- #
+
+    def follow(self, board):
+        """Adds to a replica the posts appended to the journal of the primary
+        since the last call. Returns the posts added from the journal. If
+        posts are missing, because the replica started or fell behind during
+        a compaction, they are read from the files of the primary and are not
+        returned. Posts that still can not be added are kept for the next
+        call."""
+        posts = self.pending[board] + self.tails[board].read_new()
+        added = []
+        with self.locks[board]:
+            for i, post in enumerate(posts):
+                if post["id"] > len(self.db[board]):
+                    self.catch_up(board)
+                if post["id"] > len(self.db[board]):
+                    self.pending[board] = posts[i:]
+                    return added
+                if post["id"] == len(self.db[board]):
+                    self.add_followed(board, post)
+                    added.append(post)
+            self.pending[board] = []
+        return added
+
+    def add_followed(self, board, post):
+        "Adds a post of the primary to a replica."
+        self.db[board].append(post["replyTo"], post["time"], post["content"])
+        self.db[board].bump(post["replyTo"])
+        self.index_reply(board, post["id"], post["replyTo"])
+
+    def catch_up(self, board):
+        """Reads the posts a replica missed from the newest snapshot of the
+        primary and from the journal of a compaction in progress. The posts
+        erased by the replica stay erased."""
+        loaded, _ = self.load_board(board, self.server_config[board])
+        if len(loaded) > len(self.db[board]):
+            for id in self.db[board].erased:
+                loaded.erase(id)
+            self.db[board] = loaded
+            self.index_threads(board)
+        for post in read_journal(self.journal_file(board) + ".old"):
+            if post["id"] == len(self.db[board]):
+                self.add_followed(board, post)
+
+    def flush_journals(self, interval_ms):
+        "Regularly syncs to disk the journal records not synced yet."
+        while True:
+            time.sleep(interval_ms / 1000)
+            for journal in list(self.journals.values()):
+                journal.sync()
+
+# The buffers holding the contents of a board, one after the other: the
+# segments hold the contents of the archived posts, up to the offset
+# archived_end, the snapshot mapped from mapped_start holds the ones read at
+# startup and the bytearray from contents_start holds the newer ones. They
+# are replaced at once, so that a read sees all the old ones or all the new
+# ones.
+ContentBuffers = namedtuple("ContentBuffers", ["archived", "archived_end", "mapped_start", "mapped", "contents_start", "contents"])
+
+class Board:
+    """Compact storage of the posts of a board. The ID of a post is its
+    position. The numeric fields are stored in typed arrays and the contents
+    are stored one after the other, in UTF-8, in a single buffer. Post
+    dictionaries are only made when a post is read. The content of erased
+    posts is zeroed in the buffer and read as ERASED_CONTENT. The contents of
+    a board read from a binary snapshot are mapped from the file and only
+    loaded when read, the contents of newer posts following them in the
+    buffer. The contents of the oldest posts can be archived in segments,
+    while their numeric fields stay in the arrays."""
+    def __init__(self):
+        self.reply_to = array("q")
+        self.times = array("q")
+        self.bumps = array("q")
+        self.offsets = array("Q", [0])
+        self.buffers = ContentBuffers(0, 0, 0, b"", 0, bytearray())
+        self.segments = None
+        self.erased = set()
+
+    @staticmethod
+    def from_posts(posts):
+        """Makes a board from an iterable of post dictionaries sorted by ID.
+        As boards are loaded this way at startup, the arrays are filled
+        directly rather than through append."""
+        board = Board()
+        reply_to, times, bumps, offsets = board.reply_to.append, board.times.append, board.bumps.append, board.offsets.append
+        contents = board.buffers.contents
+        extend = contents.extend
+        count = 0
+        for post in posts:
+            if post["id"] != count:
+                raise ValueError("Post " + str(post["id"]) + " is not at its place.")
+            reply_to(post["replyTo"])
+            times(post["time"])
+            bumps(post["bumpCount"])
+            extend(post["content"].encode("UTF-8"))
+            offsets(len(contents))
+            count += 1
+        return board
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __str__(self):
+        return str([self.post(i) for i in range(len(self))])
+
+    def append(self, reply_to, time, content, bump_count=0):
+        "Adds a post at the end of the board."
+        self.reply_to.append(reply_to)
+        self.times.append(time)
+        self.bumps.append(bump_count)
+        buffers = self.buffers
+        buffers.contents.extend(content.encode("UTF-8"))
+        self.offsets.append(buffers.contents_start + len(buffers.contents)) # Updated last as it gives the length
+
+    @property
+    def archived(self):
+        "Number of posts whose contents are archived in segments."
+        return self.buffers.archived
+
+    def bump(self, id):
+        "Increments the bumpCount of a post."
+        self.bumps[id] += 1
+
+    def erase(self, id):
+        """Removes the content of a post from the buffer. Segments are never
+        changed, an erased post archived in them is only hidden."""
+        start, end = self.offsets[id], self.offsets[id+1]
+        buffers = self.buffers
+        if start >= buffers.contents_start:
+            buffers.contents[start-buffers.contents_start:end-buffers.contents_start] = bytes(end - start)
+        elif start >= buffers.archived_end:
+            # Private mapping, the file is unchanged
+            buffers.mapped[start-buffers.mapped_start:end-buffers.mapped_start] = bytes(end - start)
+        self.erased.add(id)
+
+    def raw_contents(self, start, end, buffers=None):
+        """Returns the bytes of the buffers between two offsets. Archived
+        contents are read one post at a time."""
+        if buffers is None:
+            buffers = self.buffers
+        if start >= buffers.contents_start:
+            return buffers.contents[start-buffers.contents_start:end-buffers.contents_start]
+        if start < buffers.archived_end:
+            return self.segments.read(start, end)
+        if end <= buffers.contents_start:
+            return buffers.mapped[start-buffers.mapped_start:end-buffers.mapped_start]
+        return buffers.mapped[start-buffers.mapped_start:] + buffers.contents[:end-buffers.contents_start]
+
+    def archive(self, end):
+        """Drops from the RAM the contents of the posts before end, once they
+        are written in segments. The mapped snapshot is only dropped once all
+        of its contents are archived, as it is not loaded in RAM anyway."""
+        buffers = self.buffers
+        archived_end = self.offsets[end]
+        mapped_start, mapped = buffers.mapped_start, buffers.mapped
+        contents_start, contents = buffers.contents_start, buffers.contents
+        if archived_end > contents_start:
+            contents = contents[archived_end-contents_start:] # Copied, as reads may use the old buffers
+            contents_start = archived_end
+        if archived_end >= contents_start:
+            mapped_start, mapped = contents_start, b""
+        self.buffers = ContentBuffers(end, archived_end, mapped_start, mapped, contents_start, contents)
+
+    def content(self, id):
+        "Returns the content of a post."
+        if self.erased and id in self.erased:
+            return ERASED_CONTENT
+        return self.raw_contents(self.offsets[id], self.offsets[id+1]).decode("UTF-8")
+
+    def post(self, id, bump_count=None):
+        "Returns the dictionary of a post."
+        return {
+                "id":        id,
+                "time":      self.times[id],
+                "replyTo":   self.reply_to[id],
+                "content":   self.content(id),
+                "bumpCount": self.bumps[id] if bump_count is None else bump_count}
+
+    def write_json(self, path, bumps=None):
+        """Writes the board as a JSON array of posts. If bumps is given, only
+        the posts it covers are written and their bumpCount is taken from it.
+        Returns the size of the file."""
+        count = len(self) if bumps is None else len(bumps)
+        with open(path + ".tmp", "w") as f:
+            f.write("[")
+            for i in range(count):
+                if i != 0:
+                    f.write(", ")
+                f.write(json.dumps(self.post(i, None if bumps is None else bumps[i])))
+            f.write("]")
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        os.replace(path + ".tmp", path)
+        return size
+
+    def write_snapshot(self, path, bumps=None):
+        """Writes the board as a binary snapshot: a header, the blocks of the
+        numeric columns, the contents that are not archived, aligned to be
+        mapped, and the IDs of the erased posts. As with write_json, bumps
+        gives the number of posts written and their bumpCount. Returns the
+        size of the file."""
+        count = len(self) if bumps is None else len(bumps)
+        if bumps is None:
+            bumps = self.bumps[:count]
+        buffers = self.buffers # Kept, so that the posts archived meanwhile are still read from it
+        archived = min(buffers.archived, count)
+        start, end = self.offsets[archived], self.offsets[count]
+        with open(path + ".tmp", "wb") as f:
+            f.write(bytes(SNAPSHOT_HEADER.size)) # Written last, once the erased posts are known
+            for column in (self.reply_to[:count], self.times[:count], bumps, self.offsets[:count+1]):
+                write_column(f, column)
+            f.write(bytes(-f.tell() % mmap.ALLOCATIONGRANULARITY))
+            for chunk_start in range(start, end, SNAPSHOT_CHUNK):
+                f.write(self.raw_contents(chunk_start, min(end, chunk_start + SNAPSHOT_CHUNK), buffers))
+            # Read after the contents so that every zeroed content is listed
+            erased = array("q", sorted(id for id in list(self.erased) if id < count))
+            write_column(f, erased)
+            f.seek(0)
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, count, len(erased), end - start, archived))
+            f.flush()
+            os.fsync(f.fileno())
+            file_size = f.seek(0, os.SEEK_END)
+        os.replace(path + ".tmp", path)
+        return file_size
+
+    @staticmethod
+    def from_snapshot(path, segments=None):
+        """Reads a board from a binary snapshot written by write_snapshot. The
+        segments of the board are needed if some of its posts are archived."""
+        board = Board()
+        with open(path, "rb") as f:
+            header = f.read(SNAPSHOT_HEADER.size)
+            magic, version = header[:8], struct.unpack("<I", header[8:12])[0]
+            if magic != SNAPSHOT_MAGIC or version not in (1, SNAPSHOT_VERSION):
+                raise ValueError("Unknown snapshot format in " + path)
+            if version == 1:
+                _, _, count, erased_count, size = SNAPSHOT_HEADER_V1.unpack(header[:SNAPSHOT_HEADER_V1.size])
+                archived = 0
+                f.seek(SNAPSHOT_HEADER_V1.size)
+            else:
+                _, _, count, erased_count, size, archived = SNAPSHOT_HEADER.unpack(header)
+            board.reply_to = read_column(f, "q", count)
+            board.times = read_column(f, "q", count)
+            board.bumps = read_column(f, "q", count)
+            board.offsets = read_column(f, "Q", count + 1)
+            contents_start = f.tell() + (-f.tell() % mmap.ALLOCATIONGRANULARITY)
+            mapped = b""
+            if size > 0:
+                mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_COPY, offset=contents_start)
+            f.seek(contents_start + size)
+            board.erased = set(read_column(f, "q", erased_count))
+        start = board.offsets[archived]
+        board.buffers = ContentBuffers(archived, start, start, mapped, start + size, bytearray())
+        board.segments = segments
+        if segments is not None:
+            segments.load(board.offsets, archived)
+        elif archived > 0:
+            raise ValueError("Snapshot " + path + " needs its segments.")
+        return board
+
+def write_column(f, column):
+    "Writes an array in little endian."
+    if sys.byteorder == "big":
+        column = array(column.typecode, column)
+        column.byteswap()
+    f.write(column.tobytes())
+
+def read_column(f, typecode, length):
+    "Reads an array of length elements written by write_column."
+    column = array(typecode)
+    data = f.read(length * column.itemsize)
+    if len(data) != length * column.itemsize:
+        raise ValueError("Truncated snapshot " + f.name)
+    column.frombytes(data)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column
+
+def newest_snapshot(json_path, snapshot_path):
+    """Tells which snapshot of a board to read, "binary" or "json", the binary
+    one if both are as old. Returns None if there is none."""
+    try:
+        snapshot_mtime = os.stat(snapshot_path).st_mtime_ns
+    except FileNotFoundError:
+        snapshot_mtime = None
+    try:
+        json_mtime = os.stat(json_path).st_mtime_ns
+    except FileNotFoundError:
+        json_mtime = None
+    if snapshot_mtime is not None and (json_mtime is None or snapshot_mtime >= json_mtime):
+        return "binary"
+    if json_mtime is not None:
+        return "json"
+    return None
+
+class Journal:
+    """An append-only file with one JSON post per line. Records are flushed
+    to the OS on each append but only synced to the disk every few records
+    or by the periodic flusher of the DataBase, to group the costly fsync."""
+    def __init__(self, path, fsync_every):
+        self.path = path
+        self.fsync_every = fsync_every
+        self.lock = threading.Lock()
+        self.f = open(path, "ab")
+        self.count = count_lines(path)
+        self.pending = 0
+
+    def append(self, post):
+        "Writes a post at the end of the journal."
+        record = {"id": post["id"], "time": post["time"], "replyTo": post["replyTo"], "content": post["content"]}
+        with self.lock:
+            self.f.write(json.dumps(record).encode("UTF-8") + b"\n")
+            self.f.flush()
+            self.count += 1
+            self.pending += 1
+            if self.pending >= self.fsync_every:
+                os.fsync(self.f.fileno())
+                self.pending = 0
+
+    def sync(self):
+        "Makes sure every record written is on the disk."
+        with self.lock:
+            if self.pending:
+                os.fsync(self.f.fileno())
+                self.pending = 0
+
+    def rotate(self, old_path):
+        """Moves the current journal to old_path and starts an empty one. If
+        old_path is left by a compaction that failed or was interrupted, its
+        posts may not be in the snapshot, so the records are added to it
+        instead."""
+        with self.lock:
+            os.fsync(self.f.fileno())
+            self.f.close()
+            if os.path.exists(old_path):
+                with open(self.path, "rb") as journal, open(old_path, "ab") as old:
+                    shutil.copyfileobj(journal, old)
+                    old.flush()
+                    os.fsync(old.fileno())
+                # A new file, so that replicas see the rotation
+                open(self.path + ".tmp", "wb").close()
+                os.replace(self.path + ".tmp", self.path)
+            else:
+                os.replace(self.path, old_path)
+            self.f = open(self.path, "ab")
+            self.count = 0
+            self.pending = 0
+
+class JournalTail:
+    """Reader of the journal of a board written by another process. Its file
+    stays open, so that the records appended to a journal just rotated by a
+    compaction are still read. The new journal is opened once the old one
+    is read to its end."""
+    def __init__(self, path):
+        self.path = path
+        self.f = None
+        self.buffer = b""
+
+    def read_new(self):
+        "Returns the posts appended since the last call."
+        posts = []
+        while True:
+            if self.f is None:
+                try:
+                    self.f = open(self.path, "rb")
+                except FileNotFoundError: # Not made yet, or being rotated
+                    return posts
+            # Checked before reading, as nothing is written to a rotated journal
+            rotated = self.rotated()
+            lines = (self.buffer + self.f.read()).split(b"\n")
+            self.buffer = lines.pop()
+            posts += [json.loads(line) for line in lines if line]
+            if not rotated:
+                return posts
+            self.f.close()
+            self.f = None
+            self.buffer = b"" # Truncated record left by a crash
+
+    def rotated(self):
+        "Tells if the path of the journal now leads to another file."
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self.f.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+def read_journal(path):
+    "Yields the complete records of a journal file, without changing it."
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                return
+            yield json.loads(line)
+
+def first_post(board_config):
+    "The post 0 of a new board, that contains its description."
+    return {"id": 0, "time": 0, "replyTo": 0, "content": board_config["description"], "bumpCount": 1}
+
+def iter_json_array(f, chunk_size=1<<20):
+    """Yields the elements of the JSON array in the file f, without reading
+    the whole file at once. Each chunk read is parsed at once by the json
+    module up to the last object ending in it, as parsing the elements one
+    by one is much slower. If that object was in fact in a string, the chunk
+    is parsed element by element."""
+    decoder = json.JSONDecoder()
+    buf = ""
+    started = False
+    while True:
+        chunk = f.read(chunk_size)
+        buf += chunk
+        if not started:
+            buf = buf.lstrip()
+            if not buf and chunk:
+                continue
+            if not buf.startswith("["):
+                raise ValueError("Expecting a JSON array.")
+            buf = buf[1:]
+            started = True
+        if not chunk:
+            yield from json.loads("[" + buf)
+            return
+
+        # Parsing up to the last closing brace followed by a comma
+        batch = None
+        cut = buf.rfind("}")
+        while cut >= 0:
+            comma = ELEMENT_SEPARATOR.match(buf, cut + 1)
+            if comma is not None:
+                try:
+                    batch = json.loads("[" + buf[:cut+1] + "]")
+                except ValueError:
+                    pass
+                break
+            cut = buf.rfind("}", 0, cut)
+        if batch is not None:
+            yield from batch
+            buf = buf[comma.end():]
+            continue
+
+        # The last element is left, as it may be truncated
+        pos = 0
+        while True:
+            pos = SEPARATORS.match(buf, pos).end()
+            try:
+                element, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                break
+            if end == len(buf):
+                break
+            yield element
+            pos = end
+        buf = buf[pos:]
+
+def count_lines(path):
+    "Counts the number of lines in a file."
+    with open(path, "rb") as f:
+        return sum(1 for _ in f)
 
 def now_utc_unix():
     "Returns the current time at UTC in UNIX seconds."
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""
+This file contains the SQLite storage backend of the database. All the boards
+are stored in a single SQLite file, in WAL mode so that readers are never
+blocked by the writer. Only the posts being read are held in RAM.
+"""
+
+import sqlite3
+import threading
+from db import first_post, ERASED_CONTENT
+
+SQLITE_FILE = "cyberland.sqlite"
+
+# The statements are kept as constants so that the statement cache of sqlite3
+# only ever prepares them once per connection.
+CREATE_TABLE = """CREATE TABLE IF NOT EXISTS posts (
+    board     TEXT    NOT NULL,
+    id        INTEGER NOT NULL,
+    time      INTEGER NOT NULL,
+    replyTo   INTEGER NOT NULL,
+    content   TEXT    NOT NULL,
+    bumpCount INTEGER NOT NULL,
+    PRIMARY KEY (board, id)
+) WITHOUT ROWID"""
+CREATE_REPLY_INDEX = "CREATE INDEX IF NOT EXISTS posts_replies ON posts (board, replyTo, id)"
+SELECT_COUNT   = "SELECT MAX(id) + 1 FROM posts WHERE board = ?"
+SELECT_POST    = "SELECT id, time, replyTo, content, bumpCount FROM posts WHERE board = ? AND id = ?"
+SELECT_LAST    = "SELECT id, time, replyTo, content, bumpCount FROM posts WHERE board = ? AND id > ? AND id < ? ORDER BY id DESC LIMIT ?"
+SELECT_SINCE   = "SELECT id, time, replyTo, content, bumpCount FROM posts WHERE board = ? AND id > ? ORDER BY id LIMIT ?"
+SELECT_REPLIES = "SELECT id, time, replyTo, content, bumpCount FROM posts WHERE board = ? AND replyTo = ? AND id > ? ORDER BY id LIMIT ? OFFSET ?"
+SELECT_REPLIES_BEFORE = "SELECT id, time, replyTo, content, bumpCount FROM posts WHERE board = ? AND replyTo = ? AND id > ? AND id < ? ORDER BY id DESC LIMIT ?"
+INSERT_POST    = "INSERT INTO posts (board, id, time, replyTo, content, bumpCount) VALUES (?, ?, ?, ?, ?, ?)"
+BUMP_POST      = "UPDATE posts SET bumpCount = bumpCount + 1 WHERE board = ? AND id = ?"
+SELECT_REPLY_TOS = "SELECT replyTo FROM posts WHERE board = ? AND id >= ? AND id < ? ORDER BY id"
+SELECT_CONTENTS  = "SELECT content FROM posts WHERE board = ? AND id >= ? AND id < ? ORDER BY id"
+ERASE_POST     = "UPDATE posts SET content = ? WHERE board = ? AND id = ? AND content != ?"
+
+def connect(path):
+    "Opens a connection to the SQLite file and makes sure the schema exists."
+    connection = sqlite3.connect(path, isolation_level=None, cached_statements=64)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(CREATE_TABLE)
+    connection.execute(CREATE_REPLY_INDEX)
+    return connection
+
+def insert_posts(connection, board, posts):
+    "Inserts an iterable of post dictionaries in a single transaction."
+    rows = ((board, p["id"], p["time"], p["replyTo"], p["content"], p["bumpCount"]) for p in posts)
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        connection.executemany(INSERT_POST, rows)
+        connection.execute("COMMIT")
+    except:
+        connection.execute("ROLLBACK")
+        raise
+
+def row_to_post(row):
+    "Converts a row of the posts table into the dictionary sent to clients."
+    return {"id": row[0], "time": row[1], "replyTo": row[2], "content": row[3], "bumpCount": row[4]}
+
+class SQLiteStore:
+    """Storage backend keeping the posts in an SQLite file. Each thread uses
+    its own connection."""
+    def __init__(self, server_config, db_dir, settings):
+        self.path = db_dir + "/" + SQLITE_FILE
+        self.local = threading.local()
+        self.board_names = list(server_config.keys())
+        for k in self.board_names:
+            if self.count(k) == 0: # New board
+                insert_posts(self.connection(), k, [first_post(server_config[k])])
+
+    def __str__(self):
+        return "SQLite database at " + self.path
+
+    def connection(self):
+        "Returns the connection of the current thread."
+        try:
+            return self.local.connection
+        except AttributeError:
+            self.local.connection = connect(self.path)
+            return self.local.connection
+
+    def boards(self):
+        return list(self.board_names)
+
+    def count(self, board):
+        count = self.connection().execute(SELECT_COUNT, (board,)).fetchone()[0]
+        return count if count is not None else 0
+
+    def append(self, board, post):
+        """Inserts the post if its ID is still the next one of the board. A
+        post without ID gets the next one. As the transaction locks the whole
+        database, this is safe with several processes sharing it."""
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            count = connection.execute(SELECT_COUNT, (board,)).fetchone()[0]
+            if post["id"] is None:
+                post["id"] = count
+            if count != post["id"] or post["replyTo"] >= count:
+                connection.execute("ROLLBACK")
+                return False
+            connection.execute(INSERT_POST, (board, post["id"], post["time"], post["replyTo"], post["content"], 0))
+            connection.execute(BUMP_POST, (board, post["replyTo"]))
+            connection.execute("COMMIT")
+            return True
+        except:
+            connection.execute("ROLLBACK")
+            raise
+
+    def erase(self, board, id):
+        self.connection().execute(ERASE_POST, (ERASED_CONTENT, board, id, ERASED_CONTENT))
+
+    def reply_tos(self, board, start, end):
+        rows = self.connection().execute(SELECT_REPLY_TOS, (board, start, end)).fetchall()
+        return [row[0] for row in rows]
+
+    def contents(self, board, start, end):
+        rows = self.connection().execute(SELECT_CONTENTS, (board, start, end)).fetchall()
+        return [row[0] for row in rows]
+
+    def last(self, board, num, before, since=None):
+        after = -1 if since is None else since
+        rows = self.connection().execute(SELECT_LAST, (board, after, before, max(num, 0))).fetchall()
+        return [row_to_post(row) for row in rows]
+
+    def get(self, board, id):
+        row = self.connection().execute(SELECT_POST, (board, id)).fetchone()
+        if row is None:
+            return None
+        return row_to_post(row)
+
+    def replies(self, board, num, id, offset, since=None, before=None):
+        after = id if since is None else max(id, since)
+        if before is not None:
+            rows = self.connection().execute(SELECT_REPLIES_BEFORE, (board, id, after, before, num)).fetchall()
+            return [row_to_post(row) for row in reversed(rows)]
+        rows = self.connection().execute(SELECT_REPLIES, (board, id, after, num, offset)).fetchall()
+        return [row_to_post(row) for row in rows]
+
+    def since(self, board, since, num):
+        rows = self.connection().execute(SELECT_SINCE, (board, since, num)).fetchall()
+        return [row_to_post(row) for row in reversed(rows)]
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+This file contains the metrics of the server, sent by the /metrics page in
+the text format of Prometheus. Counting something only takes a lock and a
+few dictionary updates so that the metrics can be left on in production.
+When they are disabled in the server settings, nothing is counted.
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+
+# Upper bounds, in seconds, of the buckets of the duration histograms
+DURATION_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+# Length in seconds of the window of the posts per minute
+POSTS_WINDOW_S = 60
+
+DESCRIPTIONS = {
+        "cyberland_requests_total":                 ("counter",   "Requests answered, by route, method and status."),
+        "cyberland_request_duration_seconds":       ("histogram", "Time taken to answer requests, by route."),
+        "cyberland_db_write_duration_seconds":      ("histogram", "Time taken to write board files, by board and kind of write."),
+        "cyberland_db_write_bytes_total":           ("counter",   "Bytes written in board files, by board and kind of write."),
+        "cyberland_response_cache_total":           ("counter",   "Board reads by result: not_modified, hit or miss of the response cache."),
+        "cyberland_compressed_bodies_total":        ("counter",   "Compressed bodies sent by result: hit or miss of the response cache."),
+        "cyberland_segment_cache_total":            ("counter",   "Reads of archived segments by result: hit or miss of the segment cache."),
+        "cyberland_rate_limited_total":             ("counter",   "Requests refused by the rate limiter, by budget."),
+        "cyberland_anti_spam_rejects_total":        ("counter",   "Posts rejected, by reason."),
+        "cyberland_anti_spam_users":                ("gauge",     "Users whose timeout is remembered by the anti-spam."),
+        "cyberland_posts_total":                    ("counter",   "Posts made since the server started, by board."),
+        "cyberland_posts_last_minute":              ("gauge",     "Posts made in the last minute, by board."),
+        "cyberland_board_posts":                    ("gauge",     "Number of posts in each board."),
+}
+
+enabled = True
+lock = threading.Lock()
+counters = {}
+histograms = {}
+recent_posts = {}
+gauges = []
+
+class Histogram:
+    "Counts of observed values in buckets of increasing upper bounds."
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        "The lines of the histogram in the text format, with cumulative buckets."
+        ret = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ["+Inf"], self.counts):
+            cumulative += count
+            ret.append(name + "_bucket" + format_labels(labels + (("le", str(bound)),)) + " " + str(cumulative))
+        ret.append(name + "_sum" + format_labels(labels) + " " + repr(self.sum))
+        ret.append(name + "_count" + format_labels(labels) + " " + str(self.count))
+        return ret
+
+# ----------------------------- Helper functions ----------------------------- #
+
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = [k + '="' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"' for k, v in labels]
+    return "{" + ",".join(escaped) + "}"
+
+def prune_posts(times, now):
+    while times and times[0] <= now - POSTS_WINDOW_S:
+        times.popleft()
+
+# --------------------------------- Main API --------------------------------- #
+
+def enable(flag):
+    "Turns the counting on or off."
+    global enabled
+    enabled = flag
+
+def count(name, labels, value=1):
+    "Adds value to a counter."
+    if not enabled:
+        return
+    key = (name, label_key(labels))
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+def observe(name, labels, value):
+    "Adds a value, usually a duration, to a histogram."
+    if not enabled:
+        return
+    key = (name, label_key(labels))
+    with lock:
+        try:
+            histogram = histograms[key]
+        except KeyError:
+            histogram = histograms[key] = Histogram(DURATION_BUCKETS)
+        histogram.observe(value)
+
+def add_gauge(gauge):
+    """Registers a function called when the metrics are read. It returns a
+    list of (name, labels, value) tuples."""
+    gauges.append(gauge)
+
+def request_done(route, method, status, duration):
+    "Counts an answered request."
+    count("cyberland_requests_total", {"route": route, "method": method, "status": status})
+    observe("cyberland_request_duration_seconds", {"route": route}, duration)
+
+def write_done(board, kind, duration, size):
+    "Counts a write of a board file."
+    observe("cyberland_db_write_duration_seconds", {"board": board, "kind": kind}, duration)
+    count("cyberland_db_write_bytes_total", {"board": board, "kind": kind}, size)
+
+def post_made(board, post):
+    "Listener of the database counting new posts."
+    if not enabled:
+        return
+    count("cyberland_posts_total", {"board": board})
+    now = time.monotonic()
+    with lock:
+        times = recent_posts.setdefault(board, deque())
+        times.append(now)
+        prune_posts(times, now)
+
+def posts_last_minute(boards):
+    "Gauge of the posts made in the last minute on each board."
+    now = time.monotonic()
+    ret = []
+    with lock:
+        for board in boards:
+            times = recent_posts.get(board, ())
+            if times:
+                prune_posts(times, now)
+            ret.append(("cyberland_posts_last_minute", {"board": board}, len(times)))
+    return ret
+
+def render():
+    "Returns all the metrics in the text format of Prometheus."
+    samples = {}
+    with lock:
+        for (name, labels), value in counters.items():
+            samples.setdefault(name, []).append(name + format_labels(labels) + " " + str(value))
+        for (name, labels), histogram in histograms.items():
+            samples.setdefault(name, []).extend(histogram.lines(name, labels))
+    for gauge in gauges:
+        for name, labels, value in gauge():
+            samples.setdefault(name, []).append(name + format_labels(label_key(labels)) + " " + str(value))
+    lines = []
+    for name in DESCRIPTIONS:
+        if name not in samples:
+            continue
+        kind, description = DESCRIPTIONS[name]
+        lines.append("# HELP " + name + " " + description)
+        lines.append("# TYPE " + name + " " + kind)
+        lines.extend(samples[name])
+    return "\n".join(lines) + "\n"
+
+# ---------------------------------- Testing --------------------------------- #
+
+if __name__ == '__main__':
+    for i in range(10):
+        request_done("reading", "GET", 200, i / 1000)
+    post_made("test", None)
+    add_gauge(lambda: posts_last_minute(["test", "empty"]))
+    print(render())
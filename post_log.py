@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+This file contains the log of who made each post. The lines of the log are
+buffered and written by a background thread, and the log file is rotated
+when it gets too big or too old. Each post is also recorded in an SQLite
+index by the hash of the IP of its poster, so that the posts of a user can
+be found without reading the logs or the boards.
+"""
+
+import os
+import time
+import atexit
+import sqlite3
+import threading
+
+LOG_FILE = "cyberland_log"
+INDEX_FILE = "cyberland_log.sqlite"
+
+# Posts to erase, one "board id" pair per line, appended by the moderators
+PURGE_LIST = "purged.list"
+
+CREATE_TABLE = """CREATE TABLE IF NOT EXISTS posts (
+    hash  TEXT    NOT NULL,
+    board TEXT    NOT NULL,
+    id    INTEGER NOT NULL,
+    time  INTEGER NOT NULL,
+    PRIMARY KEY (hash, board, id)
+) WITHOUT ROWID"""
+INSERT_POST = "INSERT OR IGNORE INTO posts (hash, board, id, time) VALUES (?, ?, ?, ?)"
+SELECT_POSTS = "SELECT board, id, time FROM posts WHERE hash = ? ORDER BY time, board, id"
+
+def open_index(path):
+    "Opens the index, creating it if needed."
+    connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(CREATE_TABLE)
+    return connection
+
+def posts_by_hash(index_path, ip_hash):
+    "Returns the board, ID and time of all the posts made by a hash, oldest first."
+    connection = open_index(index_path)
+    try:
+        return connection.execute(SELECT_POSTS, (ip_hash,)).fetchall()
+    finally:
+        connection.close()
+
+class PostLog:
+    """Buffered log of the posts. Posts are written to the log file and to
+    the index by a background thread every flush_interval_ms. The log file
+    is rotated when it is bigger than max_bytes or older than max_age_s,
+    counted from the first write made to it by this process. A limit of 0
+    disables that kind of rotation."""
+    def __init__(self, path=LOG_FILE, index_path=INDEX_FILE, max_bytes=0, max_age_s=0, flush_interval_ms=1000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        self.flush_interval_ms = flush_interval_ms
+        self.index = open_index(index_path)
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.started_at = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def log(self, ip_hash, board, id):
+        "Records a new post. It is written at the next flush."
+        with self.lock:
+            self.buffer.append((ip_hash, board, id, int(time.time())))
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval_ms / 1000)
+            self.flush()
+
+    def flush(self):
+        "Writes the buffered posts to the log file and to the index."
+        with self.write_lock:
+            with self.lock:
+                posts = self.buffer
+                self.buffer = []
+            if not posts:
+                return
+            self.rotate_if_needed()
+            with open(self.path, "a") as f:
+                f.write("".join(ip_hash + ", " + board + ", " + str(id) + "\n" for ip_hash, board, id, _ in posts))
+            if self.started_at is None:
+                self.started_at = time.time()
+            with self.index:
+                self.index.executemany(INSERT_POST, posts)
+
+    def rotate_if_needed(self):
+        "Renames the log file with the date of its rotation if it is too big or too old."
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return
+        too_big = self.max_bytes > 0 and size >= self.max_bytes
+        too_old = self.max_age_s > 0 and self.started_at is not None and time.time() - self.started_at >= self.max_age_s
+        if not too_big and not too_old:
+            return
+        base = self.path + "." + time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+        rotated = base
+        suffix = 1
+        while os.path.exists(rotated):
+            suffix += 1
+            rotated = base + "." + str(suffix)
+        try:
+            os.replace(self.path, rotated)
+        except FileNotFoundError:
+            pass # Rotated by another process
+        self.started_at = None
+
+class PurgeList:
+    """Reader of the list of posts to erase. As the list is only appended to,
+    only its new lines are read, unless the file was replaced or shortened."""
+    def __init__(self, path=PURGE_LIST):
+        self.path = path
+        self.inode = None
+        self.offset = 0
+
+    def read_new(self):
+        "Returns the (board, id) pairs added since the last read."
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            return []
+        with f:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self.inode or stat.st_size < self.offset:
+                self.inode = stat.st_ino
+                self.offset = 0
+            f.seek(self.offset)
+            new_content = f.read()
+        complete = new_content[:new_content.rfind(b"\n")+1]
+        self.offset += len(complete)
+        ret = []
+        for line in complete.decode("UTF-8").split("\n"):
+            fields = line.split()
+            if len(fields) == 2 and fields[1].isdigit():
+                ret.append((fields[0], int(fields[1])))
+        return ret
+
+def purge(path, posts):
+    "Appends (board, id) pairs to the list of posts to erase."
+    with open(path, "a") as f:
+        f.write("".join(board + " " + str(id) + "\n" for board, id in posts))
+
+# ---------------------------------- Testing --------------------------------- #
+
+if __name__ == '__main__':
+    log = PostLog("test_log", "test_log.sqlite", max_bytes=100)
+    for i in range(10):
+        log.log("hash" + str(i % 3), "test", i)
+        log.flush()
+    print(posts_by_hash("test_log.sqlite", "hash1"))
+    purges = PurgeList("test_purged.list")
+    purge("test_purged.list", [("test", 1), ("test", 4)])
+    print(purges.read_new())
+    print(purges.read_new())
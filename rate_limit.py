@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+This file contains the rate limiter of the requests. Each client has a token
+bucket for each budget of routes, refilled at a constant rate up to a burst
+size. A request takes one token when it starts and reads take more once they
+are answered, in proportion to the number of posts they returned, so that
+dumping a board costs more than checking /status. The buckets are stored in
+a hash table in a file mapped in memory, shared by all the processes of the
+server started from the same directory, which is locked while a bucket is
+updated.
+"""
+
+import os
+import mmap
+import math
+import time
+import struct
+import hashlib
+import threading
+import metrics
+try:
+    import fcntl
+except ImportError: # Without it, the table is only shared by the threads of a process
+    fcntl = None
+
+# Budgets by name, with the tokens they get each second and the most tokens
+# they can hold. Budgets missing from the settings get these ones.
+DEFAULT_BUDGETS = {
+        "page": [5, 20],
+        "read": [20, 200],
+        "post": [1, 5],
+}
+# Pages that are not about a board, which are read from the page budget
+PAGES = {"", "static", "tut.txt", "banner.txt", "config", "status", "length", "boards", "metrics"}
+# Number of posts returned by a read that cost one more token
+POSTS_PER_TOKEN = 20
+# Number of slots looked at for a client before taking the one of another
+MAX_PROBES = 8
+
+TABLE_MAGIC = b"CYBRATE1"
+TABLE_HEADER = struct.Struct("<8sQ")
+# A slot holds the hash of a client and of a budget, the tokens of the bucket and when it was updated
+SLOT = struct.Struct("<16sdd")
+EMPTY_KEY = bytes(16)
+
+def budget_of(method, path):
+    "The budget a request is taken from, found from its method and its path."
+    name = path.strip("/").split("/")[0]
+    if name in PAGES:
+        return "page"
+    if method == "POST" and name != "batch":
+        return "post"
+    return "read"
+
+def client_of(remote_addr, real_ip):
+    """The client whose budget pays for a request: the address of the
+    connection, or for a connection from the host itself, such as the one of
+    a reverse proxy or of the router of the sharded mode, the address given in
+    the X-Real-IP header. The requests made from the host itself without this
+    header, such as the ones of the router gathering the pages about all the
+    boards, are not limited and give None."""
+    if remote_addr in ("127.0.0.1", "::1"):
+        return real_ip or None
+    return remote_addr
+
+def refusal(wait_s):
+    "The message and the headers of the reply to a refused request."
+    return ("Error, too many requests, retry in " + str(math.ceil(wait_s * 1000)) + " ms.",
+            {"Retry-After": str(math.ceil(wait_s))})
+
+class BucketTable:
+    """Hash table of token buckets in a file mapped in memory. A bucket is
+    found by looking at a few slots from the one given by its hash, so that
+    each check costs the same whatever the number of clients. Buckets that
+    were not used for idle_s seconds are full again and their slots are
+    given to new clients; if all the slots looked at are in use, the one
+    used the least recently is taken."""
+    def __init__(self, path, slots, idle_s):
+        self.idle_s = idle_s
+        self.lock = threading.Lock()
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self.locked():
+            header = os.pread(self.fd, TABLE_HEADER.size, 0)
+            if len(header) == TABLE_HEADER.size and header[:len(TABLE_MAGIC)] == TABLE_MAGIC:
+                # Another process made the table first, its size is kept
+                slots = TABLE_HEADER.unpack(header)[1]
+            else:
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, TABLE_HEADER.size + slots * SLOT.size)
+                os.pwrite(self.fd, TABLE_HEADER.pack(TABLE_MAGIC, slots), 0)
+        self.slots = slots
+        self.map = mmap.mmap(self.fd, TABLE_HEADER.size + slots * SLOT.size)
+
+    def locked(self):
+        return TableLock(self)
+
+    def take(self, key, rate, burst, cost, required):
+        """Refills the bucket of a key and takes cost tokens from it if it
+        holds at least required tokens. A bucket can go below zero, so that
+        the cost of a large read is paid by waiting longer. Returns whether
+        the tokens were taken and the tokens left."""
+        digest = hashlib.blake2b(key.encode("UTF-8"), digest_size=16).digest()
+        start = int.from_bytes(digest[:8], "little")
+        now = time.time()
+        with self.locked():
+            slot, tokens, updated = self.find(digest, start, now)
+            tokens = burst if updated is None else min(burst, tokens + (now - updated) * rate)
+            taken = tokens >= required
+            if taken:
+                tokens -= cost
+            SLOT.pack_into(self.map, slot, digest, tokens, now)
+        return taken, tokens
+
+    def find(self, digest, start, now):
+        """Returns the offset of the slot of a bucket, its tokens and when it
+        was updated, None for a new bucket."""
+        reusable = None
+        oldest, oldest_updated = None, None
+        for probe in range(MAX_PROBES):
+            slot = TABLE_HEADER.size + (start + probe) % self.slots * SLOT.size
+            key, tokens, updated = SLOT.unpack_from(self.map, slot)
+            if key == digest:
+                return slot, tokens, updated
+            if key == EMPTY_KEY:
+                # Slots are never emptied, so the bucket is not further
+                return (slot if reusable is None else reusable), 0, None
+            if reusable is None and now - updated >= self.idle_s:
+                reusable = slot
+            if oldest is None or updated < oldest_updated:
+                oldest, oldest_updated = slot, updated
+        return (oldest if reusable is None else reusable), 0, None
+
+class TableLock:
+    "Locks a table against the other threads and the other processes."
+    def __init__(self, table):
+        self.table = table
+
+    def __enter__(self):
+        self.table.lock.acquire()
+        if fcntl is not None:
+            fcntl.flock(self.table.fd, fcntl.LOCK_EX)
+
+    def __exit__(self, *args):
+        if fcntl is not None:
+            fcntl.flock(self.table.fd, fcntl.LOCK_UN)
+        self.table.lock.release()
+
+class RateLimiter:
+    "The budgets of the settings, applied with the buckets of a shared table."
+    def __init__(self, settings):
+        self.budgets = dict(DEFAULT_BUDGETS)
+        self.budgets.update(settings["rate_limits"])
+        for name, budget in self.budgets.items():
+            if len(budget) != 2 or budget[0] <= 0 or budget[1] < 1:
+                raise ValueError("The budget " + name + " needs a positive rate and a burst of at least one token.")
+        # An idle bucket is full again once all of its budget is refilled
+        idle_s = max(burst / rate for rate, burst in self.budgets.values())
+        self.table = BucketTable(settings["rate_limit_file"], settings["rate_limit_slots"], idle_s)
+
+    def admit(self, client, budget):
+        """Takes the token of a request from the budget of its client. Returns
+        None if the request is accepted, otherwise the time in seconds to wait
+        before it would be."""
+        if client is None:
+            return None
+        rate, burst = self.budgets[budget]
+        taken, tokens = self.table.take(budget + " " + client, rate, burst, 1, 1)
+        if taken:
+            return None
+        metrics.count("cyberland_rate_limited_total", {"budget": budget})
+        return (1 - tokens) / rate
+
+    def charge(self, client, budget, posts):
+        "Takes from the budget of a client the cost of the posts returned by a read."
+        cost = posts // POSTS_PER_TOKEN
+        if client is None or cost == 0:
+            return
+        rate, burst = self.budgets[budget]
+        self.table.take(budget + " " + client, rate, burst, cost, -math.inf)
+
+# ---------------------------------- Testing --------------------------------- #
+
+if __name__ == '__main__':
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        settings = {"rate_limits": {"read": [10, 3]}, "rate_limit_file": tmp + "/rate_limit.table", "rate_limit_slots": 16}
+        limiter = RateLimiter(settings)
+        print([limiter.admit("1.2.3.4", "read") for i in range(4)])
+        limiter.charge("1.2.3.4", "read", 100)
+        time.sleep(0.2)
+        print(limiter.admit("1.2.3.4", "read"), limiter.admit("1.2.3.5", "read"), limiter.admit(None, "read"))
+        print(budget_of("GET", "/status"), budget_of("POST", "/x/"), budget_of("GET", "/x/catalog"))
+        # Many clients on a small table: each check still looks at a few slots only
+        start = time.perf_counter()
+        for i in range(10000):
+            limiter.admit("10.0." + str(i // 256) + "." + str(i % 256), "page")
+        print(format((time.perf_counter() - start) / 10000 * 1e6, ".1f") + " µs per check")
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+This file contains the router of the sharded mode. The boards of config.json
+are split between worker processes, each one running cyberland.py with the
+storage and the anti-spam state of its boards only, so that a busy board
+does not slow down the others and the posts of several boards are made on
+several cores. The router starts the workers, forwards the requests of each
+board to its worker and merges the pages about all the boards. The workers
+apply the rate limit to the requests forwarded to them and the router to the
+pages it merges, with the same shared table. It only uses the standard
+library.
+Usage: router.py [--port 8901] [--asgi]
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import threading
+import subprocess
+import http.client
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from config import read_config_file, read_settings_file, settings_file, DEFAULT_PORT
+from compression import negotiate, compress
+from rate_limit import RateLimiter, client_of, refusal
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVERS = {False: "cyberland.py", True: "cyberland_asgi.py"}
+
+# Pages about all the boards, made from the pages of every worker
+MERGED_PAGES = {"status", "length", "boards", "config"}
+# Headers only meaningful for a single connection, which are not forwarded
+HOP_BY_HOP = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+              "te", "trailers", "transfer-encoding", "upgrade"}
+STREAM_CHUNK = 65536
+WORKER_START_TIMEOUT_S = 60
+CHECK_WORKERS_INTERVAL_S = 1
+
+def make_shards(server_config, shards):
+    """Splits the boards between the workers. shards lists the groups of
+    boards served by the same worker, separated by semicolons, the boards of
+    a group being separated by commas. Each board in no group gets a worker
+    of its own. Returns a boolean telling that all the boards exist and the
+    list of the groups."""
+    groups = [group.split(",") for group in shards.split(";") if group]
+    assigned = set()
+    for group in groups:
+        for board in group:
+            if board not in server_config or board in assigned:
+                print("Error, board " + board + " is unknown or in several shards.")
+                return False, groups
+            assigned.add(board)
+    groups += [[board] for board in server_config if board not in assigned]
+    return True, groups
+
+class Worker:
+    """A process serving some boards. The connections to it are kept open,
+    one for each thread of the router."""
+    def __init__(self, boards, port, asgi=False):
+        self.boards = boards
+        self.port = port
+        self.asgi = asgi
+        self.process = None
+        self.local = threading.local()
+
+    def start(self):
+        self.process = subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, SERVERS[self.asgi]),
+                                         "--boards", ",".join(self.boards), "--port", str(self.port)])
+
+    def wait_ready(self):
+        "Waits until the worker answers."
+        deadline = time.monotonic() + WORKER_START_TIMEOUT_S
+        while time.monotonic() < deadline:
+            try:
+                self.request("GET", "/status", None, {}).read()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("The worker of " + ",".join(self.boards) + " did not start.")
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+    def request(self, method, path, body, headers):
+        """Sends a request to the worker and returns the response. A kept
+        connection closed by the worker is opened again, except for posts,
+        which always use a new connection as they must not be sent twice."""
+        for attempt in range(2):
+            connection = getattr(self.local, "connection", None)
+            if connection is None or method == "POST":
+                connection = http.client.HTTPConnection("127.0.0.1", self.port)
+                if method != "POST":
+                    self.local.connection = connection
+            try:
+                connection.request(method, path, body, headers)
+                return connection.getresponse()
+            except Exception as e:
+                connection.close()
+                self.local.connection = None
+                closed = isinstance(e, (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError))
+                if not closed or attempt == 1 or method == "POST":
+                    raise
+
+# Set when the router starts
+server_config = {}
+settings = {}
+rate_limiter = None
+workers = []
+board_workers = {}
+stopping = threading.Event()
+
+def watch_workers():
+    "Starts again the workers that stopped, until the router stops."
+    while not stopping.wait(CHECK_WORKERS_INTERVAL_S):
+        for worker in workers:
+            if worker.process.poll() is not None:
+                print("The worker of " + ",".join(worker.boards) + " stopped, starting it again.")
+                worker.start()
+
+def merge(page, replies):
+    """Makes a page about all the boards from the pages of the workers about
+    their boards. The boards are listed in the order of config.json."""
+    if page == "boards":
+        order = list(server_config.keys())
+        return sorted([board for reply in replies for board in reply], key=lambda board: order.index(board["slug"]))
+    ret = {}
+    for reply in replies:
+        ret.update(reply)
+    return ret
+
+class RouterHandler(BaseHTTPRequestHandler):
+    "Forwards each request to the worker of its board."
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        parts = path.strip("/").split("/")
+        if len(parts) == 1 and parts[0] in MERGED_PAGES and self.command in ("GET", "HEAD"):
+            self.merged(parts[0])
+        elif parts == ["batch"] and self.command == "POST":
+            self.batch()
+        else:
+            # The pages that are not about a board are served by any worker
+            self.forward(board_workers.get(parts[0], workers[0]))
+
+    do_HEAD = do_GET
+    do_POST = do_GET
+    do_OPTIONS = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body, mimetype, headers={}):
+        """Sends a page made by the router, compressed like the ones of the
+        workers if the client accepts it."""
+        body = body.encode("UTF-8")
+        encoding = negotiate(self.headers.get("Accept-Encoding")) if status == 200 else None
+        if len(body) < settings["compression_min_bytes"] or settings["compression_level"] <= 0:
+            encoding = None
+        if encoding is not None:
+            body = compress(body, encoding, settings["compression_level"])
+        self.send_response(status)
+        self.send_header("Content-Type", mimetype + "; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        if status == 200:
+            self.send_header("Vary", "Accept-Encoding")
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def merged(self, page):
+        if rate_limiter is not None:
+            wait_s = rate_limiter.admit(client_of(self.client_address[0], self.headers.get("X-Real-IP")), "page")
+            if wait_s is not None:
+                message, headers = refusal(wait_s)
+                self.reply(429, message, "text/html", headers)
+                return
+        replies = []
+        for worker in workers:
+            try:
+                response = worker.request("GET", "/" + page, None, {})
+                body = response.read()
+            except OSError:
+                self.reply(502, "Error, a worker did not answer.", "text/html")
+                return
+            if response.status != 200:
+                self.reply(502, "Error, a worker did not answer.", "text/html")
+                return
+            replies.append(json.loads(body))
+        self.reply(200, json.dumps(merge(page, replies), separators=(",", ":"), sort_keys=True) + "\n", "application/json")
+
+    def batch(self):
+        """Splits a batch of reads between the workers of their boards, sends
+        them the parts at the same time and puts their answers back in the
+        order of the batch. A batch that can not be split is sent to the
+        first worker, which answers with the error."""
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            reads = json.loads(body)
+        except ValueError:
+            reads = None
+        if not isinstance(reads, list) or len(reads) > settings["batch_max_reads"]:
+            self.forward(workers[0], body)
+            return
+        parts = {}
+        for i, read in enumerate(reads):
+            board = read.get("board") if isinstance(read, dict) else None
+            board = board if isinstance(board, str) else None
+            parts.setdefault(board_workers.get(board, workers[0]), []).append(i)
+        headers = {"Content-Type": "application/json",
+                   "X-Real-IP": self.headers.get("X-Real-IP", self.client_address[0])}
+        answers = {}
+
+        def send_part(worker, indexes):
+            try:
+                response = worker.request("POST", "/batch", json.dumps([reads[i] for i in indexes]), headers)
+                answers[worker] = (response.status, response.read(), response.getheader("Retry-After"))
+            except OSError:
+                answers[worker] = (502, b"Error, the worker of this board did not answer.", None)
+
+        threads = [threading.Thread(target=send_part, args=part) for part in parts.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        items = [None] * len(reads)
+        for worker, indexes in parts.items():
+            status, answer, retry_after = answers[worker]
+            # A part refused by the rate limit or failing refuses the whole batch
+            if status != 200:
+                self.reply(status, answer.decode("UTF-8"), "text/html", {} if retry_after is None else {"Retry-After": retry_after})
+                return
+            for i, item in zip(indexes, json.loads(answer)):
+                items[i] = item
+        self.reply(200, json.dumps(items, separators=(",", ":"), sort_keys=True) + "\n", "application/json")
+
+    def forward(self, worker, body=None):
+        """Sends the request to a worker and its response to the client. The
+        responses without length, such as streams, are sent as they come and
+        the connection is closed at their end."""
+        if body is None:
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length) if length else None
+        headers = {k: v for k, v in self.headers.items() if k.lower() not in HOP_BY_HOP}
+        if "X-Real-IP" not in self.headers:
+            headers["X-Real-IP"] = self.client_address[0]
+        try:
+            response = worker.request(self.command, self.path, body, headers)
+        except OSError:
+            self.reply(502, "Error, the worker of this board did not answer.", "text/html")
+            return
+        self.send_response_only(response.status)
+        for k, v in response.getheaders():
+            if k.lower() not in HOP_BY_HOP:
+                self.send_header(k, v)
+        streamed = response.getheader("Content-Length") is None and self.command != "HEAD"
+        if streamed:
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        self.end_headers()
+        try:
+            if not streamed:
+                self.wfile.write(response.read())
+                return
+            while True:
+                chunk = response.read1(STREAM_CHUNK)
+                if not chunk:
+                    return
+                self.wfile.write(chunk)
+                self.wfile.flush()
+        finally:
+            if streamed:
+                response.close()
+
+# ---------------------------- Running the router ---------------------------- #
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Router of the sharded mode of Cyberland.")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="Port the router listens on.")
+    parser.add_argument("--asgi", action="store_true", help="Runs the workers with cyberland_asgi.py.")
+    args = parser.parse_args()
+    config_OK, server_config = read_config_file("config.json")
+    if not config_OK:
+        print("Unable to read configuration.")
+        sys.exit(1)
+    settings_OK, settings = read_settings_file(settings_file())
+    if not settings_OK:
+        print("Unable to read server settings.")
+        sys.exit(1)
+    shards_OK, shards = make_shards(server_config, settings["shards"])
+    if not shards_OK:
+        print("Unable to split the boards between workers.")
+        sys.exit(1)
+
+    if settings["rate_limit"]:
+        rate_limiter = RateLimiter(settings)
+    workers = [Worker(boards, settings["shard_base_port"] + i, args.asgi) for i, boards in enumerate(shards)]
+    board_workers = {board: worker for worker in workers for board in worker.boards}
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.wait_ready()
+        threading.Thread(target=watch_workers, daemon=True).start()
+        server = ThreadingHTTPServer(("127.0.0.1", args.port), RouterHandler)
+        server.serve_forever()
+    finally:
+        stopping.set()
+        for worker in workers:
+            worker.stop()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+This file contains the search index of a board. The index is an inverted
+index: each token maps to the sorted list of the IDs of the posts containing
+it. Tokens are the words of the posts, case-folded. The index is updated on
+each new post and saved in a binary file next to the board files, so that it
+does not have to be rebuilt at each start.
+"""
+
+import os
+import re
+import json
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+
+TOKEN = re.compile(r"\w+")
+
+# Longest token indexed, longer words are cut
+MAX_TOKEN_LENGTH = 64
+
+FILE_MAGIC = b"CYBERLAND-SEARCH-1\n"
+TOKEN_HEADER = struct.Struct("<HQ")
+
+EMPTY = array("q")
+
+def tokenize(text):
+    "Returns the distinct tokens of a text."
+    return set(token[:MAX_TOKEN_LENGTH] for token in TOKEN.findall(text.casefold()))
+
+def contains(ids, id):
+    "Tells if a sorted array contains an ID."
+    i = bisect_left(ids, id)
+    return i < len(ids) and ids[i] == id
+
+class SearchIndex:
+    """Inverted index of the posts of a board. Posts must be added in the
+    order of their IDs so that each posting list stays sorted."""
+    def __init__(self):
+        self.postings = {}
+        self.count = 0
+
+    def __len__(self):
+        return len(self.postings)
+
+    def add(self, id, content):
+        "Indexes a new post."
+        if id < self.count:
+            return
+        for token in tokenize(content):
+            try:
+                self.postings[token].append(id)
+            except KeyError:
+                self.postings[token] = array("q", [id])
+        self.count = id + 1
+
+    def add_all(self, start, contents):
+        "Indexes the posts from the ID start, given by their contents."
+        for i, content in enumerate(contents):
+            self.add(start + i, content)
+
+    def search(self, tokens, num, offset=0, before=None, since=None, skip=None):
+        """Returns the IDs of the posts containing every token, the greatest
+        first, as with reads of a board: the offset most recent ones are
+        skipped, or only the ones before and after the cursors are considered
+        and the offset is ignored. When only since is given, the posts right
+        after it are returned. The posts for which skip, if given, is true are
+        left out before the offset and num are counted."""
+        lists = sorted((self.postings.get(token, EMPTY) for token in tokens), key=len)
+        if not lists:
+            return []
+        shortest, others = lists[0], lists[1:]
+        start = 0 if since is None else bisect_right(shortest, since)
+        end = len(shortest) if before is None else bisect_left(shortest, before)
+        if since is not None and before is None:
+            candidates = range(start, end)
+        else:
+            candidates = range(end - 1, start - 1, -1)
+        if before is not None or since is not None:
+            offset = 0 # As with reads, cursors replace the offset
+        ret = []
+        for i in candidates:
+            if len(ret) >= num:
+                break
+            id = shortest[i]
+            if all(contains(ids, id) for ids in others) and not (skip is not None and skip(id)):
+                if offset > 0:
+                    offset -= 1
+                else:
+                    ret.append(id)
+        if since is not None and before is None:
+            ret.reverse()
+        return ret
+
+    def snapshot(self):
+        "Returns the number of posts indexed and the posting lists, to be saved."
+        return self.count, list(self.postings.items())
+
+    @staticmethod
+    def write(path, count, postings):
+        """Writes a snapshot of an index. Posts after count, added while the
+        snapshot was written, are left out."""
+        # Processes sharing the storage may save the same index
+        tmp_path = path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(FILE_MAGIC)
+            f.write((json.dumps({"count": count, "tokens": len(postings)}) + "\n").encode("UTF-8"))
+            for token, ids in postings:
+                length = bisect_left(ids, count)
+                encoded = token.encode("UTF-8")
+                f.write(TOKEN_HEADER.pack(len(encoded), length))
+                f.write(encoded)
+                f.write(ids[:length].tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def read(path):
+        "Reads an index written by write. Returns None if there is no valid file."
+        try:
+            with open(path, "rb") as f:
+                if f.readline() != FILE_MAGIC:
+                    return None
+                header = json.loads(f.readline())
+                index = SearchIndex()
+                index.count = header["count"]
+                for i in range(header["tokens"]):
+                    token_length, length = TOKEN_HEADER.unpack(f.read(TOKEN_HEADER.size))
+                    token = f.read(token_length).decode("UTF-8")
+                    ids = array("q")
+                    ids.frombytes(f.read(length * ids.itemsize))
+                    if length:
+                        index.postings[token] = ids
+                return index
+        except (FileNotFoundError, ValueError, struct.error):
+            return None
+
+# ---------------------------------- Testing --------------------------------- #
+
+if __name__ == '__main__':
+    index = SearchIndex()
+    index.add_all(0, ["Hello world", "hello there", "World news", "HELLO WORLD again"])
+    print(index.search(tokenize("hello world"), 10))
+    print(index.search(tokenize("hello"), 1, offset=1))
+    print(index.search(tokenize("hello"), 10, since=0))
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        SearchIndex.write(tmp + "/test.search", *index.snapshot())
+        print(SearchIndex.read(tmp + "/test.search").search(tokenize("world"), 10))
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+This file contains the archive of the contents of old posts. When a board
+only keeps its most recent posts in RAM, the contents of the older ones are
+moved to segments: immutable files holding the contents of a fixed range of
+IDs, compressed with zlib. Segments are read on demand and the decompressed
+ones are kept in a cache shared by all the boards, within a memory budget.
+"""
+
+import os
+import zlib
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+import metrics
+
+SEGMENT_SUFFIX = ".zlib"
+COMPRESSION_LEVEL = 6
+
+class SegmentCache:
+    """Least recently used decompressed segments. The oldest ones are
+    dropped when the size of the cached segments exceeds max_bytes, the last
+    one read always being kept."""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.segments = OrderedDict()
+        self.size = 0
+
+    def get(self, path):
+        "Returns the decompressed content of a segment file."
+        with self.lock:
+            data = self.segments.get(path)
+            if data is not None:
+                self.segments.move_to_end(path)
+        metrics.count("cyberland_segment_cache_total", {"result": "miss" if data is None else "hit"})
+        if data is not None:
+            return data
+        # Read out of the lock, so that hits are not slowed down by the disk
+        with open(path, "rb") as f:
+            data = zlib.decompress(f.read())
+        with self.lock:
+            if path not in self.segments:
+                self.segments[path] = data
+                self.size += len(data)
+            while self.size > self.max_bytes and len(self.segments) > 1:
+                _, dropped = self.segments.popitem(last=False)
+                self.size -= len(dropped)
+        return data
+
+class Segments:
+    """The segments of a board, in a directory of their own. Each segment is
+    named after the IDs of its first post and of the post following its last
+    one. Segments are found from the offsets of the contents of their posts
+    in the board."""
+    def __init__(self, directory, cache):
+        self.directory = directory
+        self.cache = cache
+        self.paths = []
+        self.starts = []
+
+    def path(self, first_id, end_id):
+        return os.path.join(self.directory, str(first_id) + "-" + str(end_id) + SEGMENT_SUFFIX)
+
+    def load(self, offsets, archived):
+        """Finds the segments holding the posts before archived, each one
+        starting where the previous one ends. Raises ValueError if some of
+        them are missing."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            names = []
+        ends = {}
+        for name in names:
+            ids = name[:-len(SEGMENT_SUFFIX)].split("-")
+            if name.endswith(SEGMENT_SUFFIX) and len(ids) == 2 and ids[0].isdigit() and ids[1].isdigit():
+                # Segments left by another segment size can overlap, the longest one is used
+                ends[int(ids[0])] = max(ends.get(int(ids[0]), 0), int(ids[1]))
+        first_id = 0
+        while first_id < archived:
+            if ends.get(first_id, 0) <= first_id:
+                raise ValueError("Missing segment from post " + str(first_id) + " in " + self.directory)
+            self.paths.append(self.path(first_id, ends[first_id]))
+            self.starts.append(offsets[first_id])
+            first_id = ends[first_id]
+
+    def write(self, first_id, end_id, start, data):
+        """Writes the segment of the posts from first_id to end_id, excluded,
+        whose contents start at the offset start. Returns the size of the
+        file."""
+        os.makedirs(self.directory, exist_ok=True)
+        compressed = zlib.compress(data, COMPRESSION_LEVEL)
+        path = self.path(first_id, end_id)
+        with open(path + ".tmp", "wb") as f:
+            f.write(compressed)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        # The path first, as the segments are found from their start
+        self.paths.append(path)
+        self.starts.append(start)
+        return len(compressed)
+
+    def read(self, start, end):
+        "Returns the archived contents between two offsets of the board."
+        i = bisect_right(self.starts, start) - 1
+        data = self.cache.get(self.paths[i])
+        return data[start-self.starts[i]:end-self.starts[i]]
+
+# ---------------------------------- Testing --------------------------------- #
+
+if __name__ == '__main__':
+    import tempfile
+    from array import array
+    contents = [b"first", b"second", b"third", b"fourth"]
+    offsets = array("Q", [0])
+    for content in contents:
+        offsets.append(offsets[-1] + len(content))
+    with tempfile.TemporaryDirectory() as tmp:
+        segments = Segments(tmp, SegmentCache(8))
+        segments.write(0, 2, 0, b"".join(contents[:2]))
+        segments.write(2, 4, offsets[2], b"".join(contents[2:]))
+        print([segments.read(offsets[i], offsets[i+1]) for i in range(4)])
+        reloaded = Segments(tmp, SegmentCache(8))
+        reloaded.load(offsets, 2)
+        print(reloaded.paths, reloaded.read(offsets[1], offsets[2]))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+This small tool is meant to move the boards of the JSON backend into the
+SQLite backend. It must be run from the root of the server, with the boards
+to migrate given as arguments. If no board is given, every board from
+config.json is migrated. The board files are read as streams, or mapped for
+binary snapshots, so that boards bigger than the RAM can be migrated. The
+newest of the JSON file and the binary snapshot of a board is read, as the
+server does, with the contents archived in its segments. The posts still in
+the journal of a board are migrated too.
+"""
+
+import os
+import sys
+import json
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from db import Board, iter_json_array, first_post, newest_snapshot
+from segments import Segments, SegmentCache
+from db_sqlite import connect, insert_posts, SQLITE_FILE, SELECT_COUNT, INSERT_POST, BUMP_POST
+from config import read_config_file
+
+DB_DIR = "db"
+# Archived segments are read one after the other, a small cache is enough
+SEGMENT_CACHE_BYTES = 16 * 1024 * 1024
+
+def replay_journal(connection, board, path):
+    "Inserts the posts of a journal file that are not yet in the database."
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        connection.execute("BEGIN IMMEDIATE")
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            post = json.loads(line)
+            if post["id"] < connection.execute(SELECT_COUNT, (board,)).fetchone()[0]:
+                continue
+            connection.execute(INSERT_POST, (board, post["id"], post["time"], post["replyTo"], post["content"], 0))
+            connection.execute(BUMP_POST, (board, post["replyTo"]))
+        connection.execute("COMMIT")
+
+config_OK, server_config = read_config_file("config.json")
+if not config_OK:
+    print("Unable to read configuration.")
+    sys.exit(1)
+if len(sys.argv) > 1:
+    boards = sys.argv[1:]
+else:
+    boards = list(server_config.keys())
+
+connection = connect(DB_DIR + "/" + SQLITE_FILE)
+for board in boards:
+    if connection.execute(SELECT_COUNT, (board,)).fetchone()[0] is not None:
+        print("Board " + board + " is already in the SQLite database, skipping it.")
+        continue
+    json_path = DB_DIR + "/" + board + ".json"
+    snapshot_path = DB_DIR + "/" + board + ".snap"
+    snapshot = newest_snapshot(json_path, snapshot_path)
+    if snapshot == "binary":
+        segments = Segments(DB_DIR + "/" + board + ".segments", SegmentCache(SEGMENT_CACHE_BYTES))
+        snapshot_board = Board.from_snapshot(snapshot_path, segments)
+        insert_posts(connection, board, (snapshot_board.post(i) for i in range(len(snapshot_board))))
+    elif snapshot == "json":
+        with open(json_path, "r") as f:
+            insert_posts(connection, board, iter_json_array(f))
+    else: # Board only made of its journal
+        insert_posts(connection, board, [first_post(server_config[board])])
+    replay_journal(connection, board, DB_DIR + "/" + board + ".journal.old")
+    replay_journal(connection, board, DB_DIR + "/" + board + ".journal")
+    print("Migrated board " + board + ".")
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+This small tool lets moderators find and erase the posts of a user from the
+index of the post log, without reading the logs or the boards. It must be
+run from the root of the server. Users are given by the hash of their IP,
+as written in the log, or by their IP with the hash command.
+Usage: moderate.py hash <IP>
+       moderate.py posts <hash>
+       moderate.py purge <hash>
+Purged posts are added to purged.list. A running server erases them within
+a second and a stopped one erases them when it starts.
+"""
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from post_log import posts_by_hash, purge, INDEX_FILE, PURGE_LIST
+from anti_spam import my_hash
+
+def print_posts(posts):
+    for board, id, post_time in posts:
+        print(board + " " + str(id) + " " + time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(post_time)))
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] not in ("hash", "posts", "purge"):
+        print(__doc__.strip())
+        sys.exit(1)
+    command, argument = sys.argv[1], sys.argv[2]
+    if command == "hash":
+        print(my_hash(argument))
+        sys.exit(0)
+    posts = posts_by_hash(INDEX_FILE, argument)
+    print_posts(posts)
+    if command == "purge":
+        purge(PURGE_LIST, [(board, id) for board, id, _ in posts])
+        print(str(len(posts)) + " posts added to " + PURGE_LIST + ".")
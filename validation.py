@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+This file contains the checks made on new posts before accepting them. The
+checks are made from the cheapest to the costliest: the form is checked,
+then users already waiting for their timeout are rejected before reading
+the content of their post, and the content is only read by precompiled
+regular expressions and the bad words automaton.
+"""
+
+import re
+from anti_spam import manage_request, manage_request_ret, try_to_filter, is_rate_limited
+
+# Control characters forbidden on boards without ANSI codes: every character
+# below 32 except the tabulation, the line feed and the carriage return.
+ANSI_CODE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+class Rejection:
+    """The reason a post was rejected. The reason is a short name meant to be
+    counted while the message is the one sent to the user."""
+    def __init__(self, reason, message):
+        self.reason = reason
+        self.message = message
+
+    def __str__(self):
+        return self.reason + ": " + self.message
+
+def spam_rejection(request):
+    """Counts a posting attempt for the anti-spam. Returns a Rejection if the
+    user must wait, None otherwise."""
+    OK_to_post, timeout = manage_request(request)
+    if OK_to_post == manage_request_ret["Limit"]:
+        return Rejection("rate_limit", "Error, you must wait " + str(timeout) + " ms before posting again.")
+    elif OK_to_post == manage_request_ret["First_time"]:
+        return Rejection("first_time", "As it is your first time posting, you must wait " + str(timeout) + " ms before posting.")
+    return None
+
+def validate_post(board, board_config, content, replyTo, request):
+    """Checks a new post. Returns a Rejection, or None if the post can be made,
+    and the replyTo field converted to an integer."""
+    # Testing the arguments
+    if not replyTo or replyTo == 'null':
+        replyTo = '0'
+    if not replyTo.isdigit():
+        return Rejection("reply_to", "Error, replyTo is not a number nor null!"), None
+    replyTo = int(replyTo)
+    if not content:
+        return Rejection("no_content", "Error, no content provided."), replyTo
+    if len(content) > board_config["max_post_size"]:
+        return Rejection("too_long", "Error, post too long. Max size = "+str(board_config["max_post_size"])+", size of the message = "+str(len(content))+"."), replyTo
+
+    # Rejecting users that must wait without reading their post. Their wait
+    # may end before the attempt is counted, the post is then checked as usual.
+    counted = False
+    if is_rate_limited(request):
+        rejection = spam_rejection(request)
+        if rejection is not None:
+            return rejection, replyTo
+        counted = True
+
+    # Checking for ANSI codes
+    if not board_config["enable_ansi_code"] and ANSI_CODE.search(content):
+        return Rejection("ansi", "Error, unauthorized char. ANSI code are not allowed."), replyTo
+
+    # Checking for spam
+    if not counted:
+        rejection = spam_rejection(request)
+        if rejection is not None:
+            return rejection, replyTo
+
+    # Checking for forbidden words
+    if not try_to_filter(content, request, board):
+        return Rejection("bad_words", "Clean your mouth with soap!"), replyTo
+
+    return None, replyTo
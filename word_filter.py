@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+This file contains the matcher used to look for forbidden words in posts.
+All the words are compiled in a single Aho-Corasick automaton so that a
+message is read only once, whatever the number of words.
+"""
+
+class WordMatcher:
+    """Aho-Corasick automaton telling if a text contains any of a list of
+    words. Each state is a node of the trie of the words, with a dictionary
+    of its transitions, the state to fall back to when no transition matches
+    and a flag telling if a word ends in this state or in a state it falls
+    back to."""
+    def __init__(self, words):
+        self.goto = [{}]
+        self.fail = [0]
+        self.match = [False]
+
+        # Building the trie
+        for word in words:
+            state = 0
+            for c in word:
+                try:
+                    state = self.goto[state][c]
+                except KeyError:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.match.append(False)
+                    self.goto[state][c] = len(self.goto) - 1
+                    state = len(self.goto) - 1
+            self.match[state] = True
+
+        # Computing fall back states in breadth-first order
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for c, next_state in self.goto[state].items():
+                fallback = self.fail[state]
+                while fallback != 0 and c not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                if state != 0 and c in self.goto[fallback]:
+                    fallback = self.goto[fallback][c]
+                self.fail[next_state] = fallback
+                self.match[next_state] = self.match[next_state] or self.match[fallback]
+                queue.append(next_state)
+
+    def search(self, text):
+        "Returns True if any of the words is in the text."
+        goto = self.goto
+        fail = self.fail
+        match = self.match
+        if match[0]: # The empty word is in every text
+            return True
+        state = 0
+        for c in text:
+            while state != 0 and c not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(c, 0)
+            if match[state]:
+                return True
+        return False
+
+# ---------------------------------- Testing --------------------------------- #
+
+if __name__ == '__main__':
+    matcher = WordMatcher(["he", "she", "his", "hers"])
+    print(matcher.search("ushers"))
+    print(matcher.search("ahis"))
+    print(matcher.search("hhe"))
+    print(matcher.search("sh"))
+    print(WordMatcher([]).search("anything"))
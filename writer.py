@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+This file contains the background writer. It makes the disk writes of the
+server in a thread of its own so that the requests never wait for the disk.
+"""
+
+import queue
+import threading
+import traceback
+
+class BackgroundWriter:
+    """Runs the jobs it is given one after the other, in the order they were
+    submitted, in a dedicated thread. A job submitted with a key is skipped if
+    a job with the same key is still waiting, as rewriting a file once takes
+    into account all the changes made before."""
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, job, *args, key=None):
+        "Queues a call to job with the given arguments."
+        if key is not None:
+            with self.lock:
+                if key in self.pending:
+                    return
+                self.pending.add(key)
+        self.queue.put((key, job, args))
+
+    def run(self):
+        while True:
+            key, job, args = self.queue.get()
+            if key is not None:
+                # Forgotten before running so that later changes queue a new job
+                with self.lock:
+                    self.pending.discard(key)
+            try:
+                job(*args)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        "Waits until every job submitted so far is done."
+        self.queue.join()
+
+# ---------------------------------- Testing --------------------------------- #
+
+if __name__ == '__main__':
+    writer = BackgroundWriter()
+    for i in range(5):
+        writer.submit(print, "job", i)
+        writer.submit(print, "coalesced job", i, key="same")
+    writer.flush()